@@ -0,0 +1,319 @@
+#
+# iex_bench - End-to-end benchmarks of the IEX extension against a local stub server
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Usage (from the repository root):
+#   python bench/iex_bench.py                    Run and compare with bench/baseline.json
+#   python bench/iex_bench.py --save-baseline    Run and replace bench/baseline.json
+#
+# The extension runs against StubIEXServer with its own iex.conf, cache DB and
+# log in a temporary home folder, so the live IEX service and your own cache
+# are never touched. The exit status is 1 if any scenario regressed.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import importlib
+import importlib.util
+import threading
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+src_dir = os.path.join(os.path.dirname(bench_dir), "src")
+baseline_file = os.path.join(bench_dir, "baseline.json")
+
+# Cached calls take microseconds, so the warm scenario makes this many times more calls
+warm_ops_factor = 20
+# Latencies below this are not compared with the baseline (ms)
+noise_floor_ms = 2 * sys.getswitchinterval() * 1000.0
+
+# Item keys used by the scenarios
+quote_keys = ["latestPrice", "change", "changePercent", "marketCap", "peRatio", "week52High"]
+company_keys = ["companyName", "industry", "sector", "CEO"]
+keystats_keys = ["beta", "dividendYield", "marketcap", "ttmEPS"]
+
+
+def percentile(samples, p):
+    """
+    Returns the pth percentile of a sorted list of samples.
+    """
+    if not samples:
+        return 0.0
+    i = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[i]
+
+
+class Bench:
+    """
+    Runs the scenarios and collects their latencies
+    """
+    def __init__(self, stub, threads, ops):
+        self.stub = stub
+        self.threads = threads
+        self.ops = ops
+        self.iex = {}
+        for name in ["iex_quote", "iex_company", "iex_keystats", "iex_dividends", "iex_earnings",
+                     "iex_chart", "iex_price"]:
+            self.iex[name] = importlib.import_module(name)
+        # IexImpl needs the UNO runtime, which only exists inside LibreOffice
+        self.impl = None
+        if importlib.util.find_spec("unohelper"):
+            self.impl = importlib.import_module("iex_impl").IexImpl(None)
+        self._symbol_seq = 0
+        self._lock = threading.Lock()
+
+    def new_symbols(self, n):
+        """
+        Returns symbols that have never been requested, i.e. are not cached.
+        """
+        with self._lock:
+            first = self._symbol_seq
+            self._symbol_seq += n
+        return ["S{0:05d}".format(i) for i in range(first, first + n)]
+
+    def operations(self):
+        """
+        Returns the operations of a recalculation as (name, function(symbol)).
+        The IexImpl methods are used when the UNO runtime is available.
+        """
+        iex = self.iex
+        end = time.strftime("%Y-%m-%d")
+        start = time.strftime("%Y-%m-%d", time.localtime(time.time() - 90 * 24 * 60 * 60))
+        ops = [
+            ("quote_item", lambda s: iex["iex_quote"].get_quote_item(s, random.choice(quote_keys))),
+            ("company_item", lambda s: iex["iex_company"].get_company_item(s, random.choice(company_keys))),
+            ("keystats_item", lambda s: iex["iex_keystats"].get_keystats_item(s, random.choice(keystats_keys))),
+            ("dividends_item", lambda s: iex["iex_dividends"].get_dividends_item(s, "amount", 0, "1y")),
+            ("earnings_item", lambda s: iex["iex_earnings"].get_earnings_item(s, "actualEPS", 0)),
+            ("price", lambda s: iex["iex_price"].get_price(s)),
+            ("historical_series", lambda s: iex["iex_chart"].get_historical_series(s, start, end)),
+        ]
+        if self.impl:
+            impl = self.impl
+            ops += [
+                ("impl_quote_item", lambda s: impl.IexQuoteItem(s, random.choice(quote_keys))),
+                ("impl_historical_quote", lambda s: impl.IexHistoricalQuote(s, end)),
+            ]
+        return ops
+
+    def _run(self, work):
+        """
+        Run work items (name, fn, symbol) on the configured number of threads.
+        :return: (elapsed seconds, sorted latencies in ms, errors)
+        """
+        latencies = []
+        errors = []
+        items = list(work)
+        next_item = [0]
+
+        def worker():
+            while True:
+                with self._lock:
+                    if next_item[0] >= len(items):
+                        return
+                    name, fn, symbol = items[next_item[0]]
+                    next_item[0] += 1
+                t = time.perf_counter()
+                try:
+                    fn(symbol)
+                except Exception as ex:
+                    errors.append("{0} {1}: {2}".format(name, symbol, str(ex)))
+                ms = (time.perf_counter() - t) * 1000.0
+                with self._lock:
+                    latencies.append(ms)
+
+        start = time.perf_counter()
+        workers = [threading.Thread(target=worker) for i in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        return time.perf_counter() - start, sorted(latencies), errors
+
+    def cold(self):
+        """
+        Every call is for a symbol that has not been seen, so every call goes to IEX.
+        """
+        ops = self.operations()
+        work = [(name, fn, s) for s in self.new_symbols(self.ops // len(ops) + 1) for name, fn in ops]
+        return work[:self.ops]
+
+    def warm(self):
+        """
+        Every call is for a symbol that is already cached. No call should go to IEX.
+        """
+        ops = self.operations()
+        symbols = self.new_symbols(20)
+        # Load the cache
+        self._run([(name, fn, s) for s in symbols for name, fn in ops])
+        return [(name, fn, random.choice(symbols)) for name, fn in
+                (random.choice(ops) for i in range(self.ops * warm_ops_factor))]
+
+    def mixed(self):
+        """
+        A sheet being recalculated: 90% of the calls are for cached symbols,
+        10% are for new ones, plus tables over all cached symbols.
+        """
+        ops = self.operations()
+        symbols = self.new_symbols(20)
+        self._run([(name, fn, s) for s in symbols for name, fn in ops])
+        iex = self.iex
+        table_ops = [
+            ("quote_table", lambda s: iex["iex_quote"].get_quote_table(tuple((x,) for x in symbols),
+                                                                       (tuple(quote_keys),))),
+            ("keystats_table", lambda s: iex["iex_keystats"].get_keystats_table(tuple((x,) for x in symbols),
+                                                                                (tuple(keystats_keys),))),
+        ]
+        work = []
+        for i in range(self.ops):
+            r = random.random()
+            if r < 0.05:
+                name, fn = random.choice(table_ops)
+                work.append((name, fn, None))
+            elif r < 0.15:
+                name, fn = random.choice(ops)
+                work.append((name, fn, self.new_symbols(1)[0]))
+            else:
+                name, fn = random.choice(ops)
+                work.append((name, fn, random.choice(symbols)))
+        return work
+
+    def run(self, scenario, repeat):
+        """
+        Run a scenario repeat times and return the fastest run. The fastest
+        run is the one least disturbed by whatever else the machine is doing.
+        """
+        runs = [self._run_once(scenario) for i in range(repeat)]
+        return max(runs, key=lambda r: r["throughput"])
+
+    def _run_once(self, scenario):
+        random.seed(scenario)
+        work = getattr(self, scenario)()
+        requests = self.stub.request_count()
+        elapsed, latencies, errors = self._run(work)
+        return {
+            "ops": len(latencies),
+            "throughput": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p90_ms": round(percentile(latencies, 90), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "http_requests": self.stub.request_count() - requests,
+            "errors": errors
+        }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of regressions against the baseline.
+    """
+    regressions = []
+    for scenario, r in results.items():
+        if r["errors"]:
+            regressions.append("{0}: {1} calls failed, first: {2}".format(scenario, len(r["errors"]),
+                                                                            r["errors"][0]))
+        if scenario == "warm" and r["http_requests"]:
+            regressions.append("warm: {0} calls to IEX with a warm cache".format(r["http_requests"]))
+        b = baseline.get(scenario)
+        if not b:
+            continue
+        if r["throughput"] < b["throughput"] * (1.0 - tolerance):
+            regressions.append("{0}: throughput {1} ops/s, baseline {2} ops/s".format(
+                scenario, r["throughput"], b["throughput"]))
+        # p99 is reported but not compared. It rests on a handful of samples.
+        for p in ("p50_ms", "p90_ms"):
+            # Latencies shorter than a couple of thread switch intervals are
+            # mostly waiting for the GIL and too noisy to compare
+            if r[p] > max(b[p], noise_floor_ms) * (1.0 + tolerance):
+                regressions.append("{0}: {1} {2} ms, baseline {3} ms".format(scenario, p, r[p], b[p]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the IEX extension against a local stub server")
+    parser.add_argument("--scenarios", default="cold,warm,mixed", help="Comma separated scenarios")
+    parser.add_argument("--ops", type=int, default=500, help="Calls per scenario")
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent callers")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scenario (the fastest is reported)")
+    parser.add_argument("--latency", type=float, default=0.02, help="Stub server latency (seconds)")
+    parser.add_argument("--tolerance", type=float, default=0.35,
+                        help="Allowed fraction of regression against the baseline")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="Requests per second allowed by the extension's rate limiter (0 for no limit)")
+    parser.add_argument("--certfile", help="Serve HTTPS with this certificate (also trusted by the client)")
+    parser.add_argument("--keyfile", help="Private key of --certfile")
+    parser.add_argument("--save-baseline", action="store_true", help="Replace the baseline with this run")
+    args = parser.parse_args()
+
+    # Isolate iex.conf, the cache DB and the log before the extension is imported
+    home = tempfile.mkdtemp(prefix="iex-bench-")
+    os.environ["HOME"] = home
+    os.environ["LOCALAPPDATA"] = home
+    sys.path.insert(0, src_dir)
+    sys.path.insert(0, bench_dir)
+    from stub_server import StubIEXServer
+    from iex_lib import QConfiguration
+    import url_helpers
+
+    stub = StubIEXServer(os.path.join(bench_dir, "payloads"), latency=args.latency,
+                         certfile=args.certfile, keyfile=args.keyfile)
+    QConfiguration.base_url = stub.start()
+    if args.certfile:
+        url_helpers.setup_cacerts(args.certfile)
+    # The stub does not limit requests the way IEX does
+    url_helpers.setup_rate_limiter(args.rate_limit, QConfiguration.rate_limit_burst, QConfiguration.max_retries,
+                                  QConfiguration.rate_limit_max_wait)
+
+    try:
+        bench = Bench(stub, args.threads, args.ops)
+        if not bench.impl:
+            print("UNO runtime not found: IexImpl methods are not benchmarked")
+        results = {}
+        for scenario in args.scenarios.split(","):
+            results[scenario] = bench.run(scenario, args.repeat)
+    finally:
+        stub.stop()
+        shutil.rmtree(home, ignore_errors=True)
+
+    print("{0:<8}{1:>7}{2:>12}{3:>10}{4:>10}{5:>10}{6:>10}".format(
+        "scenario", "ops", "ops/s", "p50 ms", "p90 ms", "p99 ms", "requests"))
+    for scenario, r in results.items():
+        print("{0:<8}{1:>7}{2:>12}{3:>10}{4:>10}{5:>10}{6:>10}".format(
+            scenario, r["ops"], r["throughput"], r["p50_ms"], r["p90_ms"], r["p99_ms"], r["http_requests"]))
+
+    if args.save_baseline:
+        baseline = {s: {k: r[k] for k in ("throughput", "p50_ms", "p90_ms", "p99_ms")}
+                    for s, r in results.items()}
+        with open(baseline_file, "w") as fh:
+            json.dump(baseline, fh, indent=4, sort_keys=True)
+        print("Baseline saved to", baseline_file)
+        return 0
+
+    baseline = {}
+    if os.path.exists(baseline_file):
+        with open(baseline_file, "r") as fh:
+            baseline = json.load(fh)
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print("REGRESSION", r)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,193 @@
+#
+# stub_server - Local stand-in for the IEX 1.0 API used by the benchmarks
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# The server answers the /stock endpoints used by the extension from the
+# payloads recorded in the payloads folder. Every symbol gets the same
+# payload with its symbol substituted. Chart payloads are extended to the
+# requested period by repeating the recorded bars on earlier trading days.
+#
+
+import os
+import json
+import ssl
+import gzip
+import time
+import datetime
+import threading
+import urllib.parse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# Calendar days in each chart/dividends range
+range_days = {"1m": 30, "3m": 91, "6m": 182, "ytd": None, "1y": 365, "2y": 730, "5y": 1826}
+# Batch types served by /stock/market/batch
+batch_files = {"quote": "quote", "company": "company", "stats": "stats", "price": "price",
+               "earnings": "earnings"}
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubIEXServer:
+    """
+    Serves recorded IEX payloads on 127.0.0.1 with a configurable latency
+    """
+    def __init__(self, payload_dir, latency=0.0, certfile=None, keyfile=None):
+        """
+        :param payload_dir: Folder containing the recorded payloads
+        :param latency: Seconds added to every response
+        :param certfile: Certificate for serving HTTPS. HTTP if None.
+        :param keyfile: Private key of certfile
+        """
+        self.latency = latency
+        self.payloads = {}
+        for f in os.listdir(payload_dir):
+            if f.endswith(".json"):
+                with open(os.path.join(payload_dir, f), "r") as fh:
+                    self.payloads[f[:-5]] = json.load(fh)
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._server = _ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self.scheme = "http"
+        if certfile:
+            ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ctx.load_cert_chain(certfile, keyfile)
+            self._server.socket = ctx.wrap_socket(self._server.socket, server_side=True)
+            self.scheme = "https"
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "{0}://127.0.0.1:{1}/1.0".format(self.scheme, self._server.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="iex-stub")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def request_count(self):
+        with self._lock:
+            return self.requests
+
+    def payload(self, category, symbol, period=None):
+        """
+        Returns the payload of a category for a symbol.
+        :param category: quote, company, stats, price, earnings, chart or dividends
+        :param symbol: Ticker symbol
+        :param period: Range for chart and dividends
+        :return: The payload or None if there is no such category
+        """
+        p = self.payloads.get(category)
+        if p is None:
+            return None
+        if category == "chart":
+            return self._chart(p, period)
+        if category == "dividends":
+            return self._dividends(p, period)
+        if isinstance(p, dict):
+            p = dict(p)
+            if "symbol" in p:
+                p["symbol"] = symbol
+        return p
+
+    @staticmethod
+    def _first_date(period):
+        today = datetime.date.today()
+        if period == "ytd":
+            return datetime.date(today.year, 1, 1)
+        return today - datetime.timedelta(days=range_days.get(period, 30))
+
+    def _chart(self, bars, period):
+        first = StubIEXServer._first_date(period)
+        d = datetime.date.today()
+        out = []
+        i = 0
+        while d >= first:
+            if d.weekday() < 5:
+                bar = dict(bars[i % len(bars)])
+                bar["date"] = d.isoformat()
+                bar["label"] = d.strftime("%b %d")
+                out.append(bar)
+                i += 1
+            d -= datetime.timedelta(days=1)
+        out.reverse()
+        return out
+
+    def _dividends(self, recorded, period):
+        first = StubIEXServer._first_date(period)
+        d = datetime.date.today() - datetime.timedelta(days=15)
+        out = []
+        i = 0
+        while d >= first:
+            div = dict(recorded[i % len(recorded)])
+            for k in ("exDate", "paymentDate", "recordDate", "declaredDate"):
+                div[k] = d.isoformat()
+            out.append(div)
+            i += 1
+            d -= datetime.timedelta(days=91)
+        return out
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately. With Nagle's algorithm
+            # the body would wait for a delayed ACK.
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                with stub._lock:
+                    stub.requests += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                url = urllib.parse.urlparse(self.path)
+                parts = url.path.strip("/").split("/")[1:]
+                body = None
+                if len(parts) >= 3 and parts[0] == "stock" and parts[1] == "market" and parts[2] == "batch":
+                    q = urllib.parse.parse_qs(url.query)
+                    body = {}
+                    for symbol in q.get("symbols", [""])[0].split(","):
+                        body[symbol] = {t: stub.payload(batch_files.get(t, t), symbol)
+                                        for t in q.get("types", [""])[0].split(",")}
+                elif len(parts) >= 3 and parts[0] == "stock":
+                    period = parts[3] if len(parts) > 3 else "1m"
+                    body = stub.payload(parts[2], parts[1].upper(), period)
+                if body is None:
+                    self.send_response(404, "Not Found")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                if "gzip" in self.headers.get("Accept-Encoding", ""):
+                    data = gzip.compress(data, 6)
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
@@ -112,6 +112,11 @@ shutil.copy("src/iex_chart.py", "build/")
 shutil.copy("src/extn_helper.py", "build/")
 shutil.copy("src/url_helpers.py", "build/")
 shutil.copy("src/cache_db.py", "build/")
+shutil.copy("src/iex_cache.py", "build/")
+shutil.copy("src/iex_prefetch.py", "build/")
+shutil.copy("src/iex_schema.py", "build/")
+shutil.copy("src/iex_metrics.py", "build/")
+shutil.copy("src/history_store.py", "build/")
 shutil.copy("certifi/cacert.pem", "build/")
 
 # Generate the XCU file
@@ -139,6 +144,11 @@ xcu.add_function("IexQuoteItem", "Get a quote item by its key",
                      ('symbol', 'The stock ticker symbol for the quote'),
                      ('itemkey', 'The item key')
                  ])
+xcu.add_function("IexQuoteTable", "Get a table of quote items for a range of symbols and keys",
+                 [
+                     ('symbols', 'Range of stock ticker symbols, one row per symbol'),
+                     ('itemkeys', 'Range of item keys, one column per key')
+                 ])
 xcu.add_function("IexCompanyKeyCount", "Get count of keys in a company",
                  [
                  ])
@@ -151,6 +161,11 @@ xcu.add_function("IexCompanyItem", "Get a company item by its key",
                      ('symbol', 'The stock ticker symbol for the quote'),
                      ('itemkey', 'The item key')
                  ])
+xcu.add_function("IexCompanyTable", "Get a table of company items for a range of symbols and keys",
+                 [
+                     ('symbols', 'Range of stock ticker symbols, one row per symbol'),
+                     ('itemkeys', 'Range of item keys, one column per key')
+                 ])
 xcu.add_function("IexKeyStatsKeyCount", "Get count of keys in a key stats result",
                  [
                  ])
@@ -163,6 +178,11 @@ xcu.add_function("IexKeyStatsItem", "Get a key stats item by its key",
                      ('symbol', 'The stock ticker symbol for the dividends'),
                      ('itemkey', 'The item key')
                  ])
+xcu.add_function("IexKeyStatsTable", "Get a table of key stats items for a range of symbols and keys",
+                 [
+                     ('symbols', 'Range of stock ticker symbols, one row per symbol'),
+                     ('itemkeys', 'Range of item keys, one column per key')
+                 ])
 xcu.add_function("IexDividendsKeyCount", "Get count of keys in a dividend period result",
                  [
                      ('symbol', 'The stock ticker symbol for the dividends'),
@@ -206,6 +226,22 @@ xcu.add_function("IexHistoricalQuote", "Get a closing quote for a date",
                      ('symbol', 'The stock ticker symbol for the quote'),
                      ('fordate', 'The date YYYY-MM-DD')
                  ])
+xcu.add_function("IexHistoricalItem", "Get a historical daily item for a date",
+                 [
+                     ('symbol', 'The stock ticker symbol for the quote'),
+                     ('fordate', 'The date YYYY-MM-DD'),
+                     ('itemkey', 'open, high, low, close, volume or adjclose')
+                 ])
+xcu.add_function("IexHistoricalSeries", "Get closing quotes for a date range",
+                 [
+                     ('symbol', 'The stock ticker symbol for the quotes'),
+                     ('startdate', 'The first date YYYY-MM-DD'),
+                     ('enddate', 'The last date YYYY-MM-DD, today if empty')
+                 ])
+xcu.add_function("IexStats", "Get a runtime metric of the extension",
+                 [
+                     ('metric', 'Metric name (e.g. http.latency.p90_ms or cache.quote.hit_ratio)')
+                 ])
 
 xcu.generate("build/iex.xcu")
 xcu.dump_functions()
@@ -17,7 +17,11 @@
 
 from iex_app_logger import AppLogger
 from iex_lib import QConfiguration
+from iex_metrics import metrics
 import os
+import time
+import threading
+import atexit
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -32,16 +36,52 @@ except Exception as ex:
     logger.error("sqlite3 unavailable; cache disabled")
     logger.error(str(ex))
 
+# SQL statements. sqlite3 caches a prepared statement per connection for each
+# distinct statement text, so these are defined once and reused.
+SELECT_CLOSING_PRICE = "SELECT * from SymbolDate where Symbol=? and Date=?"
+INSERT_CLOSING_PRICE = "INSERT OR REPLACE INTO SymbolDate values (?,?,?,?,?,?,?,?)"
+SELECT_CLOSING_PRICE_RANGE = "SELECT Date, Close from SymbolDate where Symbol=? and Date>=? and Date<=? order by Date"
+SELECT_DAILY_BARS = "SELECT * from SymbolDate where Symbol=? order by Date"
+SELECT_COVERAGE = "SELECT * from SymbolCoverage where Symbol=?"
+INSERT_COVERAGE = "INSERT OR REPLACE INTO SymbolCoverage values (?,?,?)"
+SELECT_RESULT_BLOB = "SELECT * from ResultBlob where Category=? and CacheKey=? and RetainUntil>?"
+INSERT_RESULT_BLOB = "INSERT OR REPLACE INTO ResultBlob values (?,?,?,?,?)"
+DELETE_RESULT_BLOBS = "DELETE from ResultBlob where RetainUntil<=?"
+SELECT_RESULT_KEYS = "SELECT * from ResultKeys where Category=?"
+INSERT_RESULT_KEYS = "INSERT OR REPLACE INTO ResultKeys values (?,?)"
+INSERT_DIVIDEND = "INSERT OR REPLACE INTO DividendHistory values (?,?,?,?,?,?)"
+SUM_DIVIDENDS_IN_RANGE = "SELECT total(Amount) from DividendHistory where Symbol=? and ExDate>? and ExDate<=?"
+SELECT_DIVIDEND_COVERAGE = "SELECT * from DividendCoverage where Symbol=?"
+INSERT_DIVIDEND_COVERAGE = "INSERT OR REPLACE INTO DividendCoverage values (?,?,?)"
+
 
 class CacheDB:
+    # Connection tuning
+    busy_timeout_ms = 5000
+    # Negative values are KB (i.e. 8MB)
+    page_cache_size = -8000
+    mmap_size = 64 * 1024 * 1024
+
+    # Seconds between purges of expired ResultBlob rows while results are written
+    purge_interval = 10 * 60
+    _next_purge = 0.0
+
+    # Resolved path of the cache DB. Set once the schema has been checked.
+    db_path = None
+    # sqlite3 connections can't be shared across threads. Each thread
+    # keeps its own connection: {thread ident: connection}
+    _connections = {}
+    _lock = threading.Lock()
+
     @classmethod
-    def __open_yh_cache(cls):
+    def __init_yh_cache(cls):
         """
-        Open a connection to the cache DB. Create the DB if it does not exist.
-        :return: Database connection.
+        Create the cache DB and its tables if they do not exist. This is done
+        once, when the first connection is opened.
+        :return: None
         """
         # Determine cache location based on underlying OS
-        full_file_path = QConfiguration.iex_cache_db
+        full_file_path = os.path.expanduser(QConfiguration.iex_cache_db)
         file_path = os.path.dirname(full_file_path)
 
         # Make the folder if it does not exist
@@ -49,24 +89,94 @@ class CacheDB:
             logger.info("Create directory")
             os.makedirs(file_path)
 
-        # If DB does not exist, create it
-        if not os.path.exists(full_file_path):
-            logger.info("Create database")
-            conn = sqlite3.connect(full_file_path)
-            conn.execute("CREATE TABLE SymbolDate (Symbol text not null, Date text not null, Open real, High real, Low real, Close real, Volume integer, Adj_Close real, PRIMARY KEY(Symbol,Date))")
-            conn.execute("CREATE TABLE TTMDividends (Symbol TEXT NOT NULL, CalcDate TEXT NOT NULL, Amount REAL NOT NULL, PRIMARY KEY(Symbol,CalcDate))")
-        else:
-            conn = sqlite3.connect(full_file_path)
+        conn = sqlite3.connect(full_file_path)
+        # Write-ahead logging lets readers proceed while another thread writes.
+        # The journal mode is persistent, so it only needs to be set here.
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS SymbolDate (Symbol text not null, Date text not null, Open real, High real, Low real, Close real, Volume integer, Adj_Close real, PRIMARY KEY(Symbol,Date))")
+        # The date interval for which every trading day of a symbol is in SymbolDate
+        conn.execute("CREATE TABLE IF NOT EXISTS SymbolCoverage (Symbol TEXT NOT NULL, FirstDate TEXT NOT NULL, LastDate TEXT NOT NULL, PRIMARY KEY(Symbol))")
+        # Compressed JSON results with their expiration (Unix time)
+        conn.execute("CREATE TABLE IF NOT EXISTS ResultBlob (Category TEXT NOT NULL, CacheKey TEXT NOT NULL, Expiration REAL NOT NULL, RetainUntil REAL NOT NULL, Payload BLOB NOT NULL, PRIMARY KEY(Category,CacheKey))")
+        # Results that can no longer be used
+        conn.execute(DELETE_RESULT_BLOBS, [time.time()])
+        # Item keys (JSON list) discovered for each result category
+        conn.execute("CREATE TABLE IF NOT EXISTS ResultKeys (Category TEXT NOT NULL, Keys TEXT NOT NULL, PRIMARY KEY(Category))")
+        # Every dividend fetched for a symbol. The primary key index serves ExDate range sums.
+        conn.execute("CREATE TABLE IF NOT EXISTS DividendHistory (Symbol TEXT NOT NULL, ExDate TEXT NOT NULL, Amount REAL NOT NULL, PaymentDate TEXT, RecordDate TEXT, DeclaredDate TEXT, PRIMARY KEY(Symbol,ExDate))")
+        # The ex-date interval for which every dividend of a symbol is in DividendHistory
+        conn.execute("CREATE TABLE IF NOT EXISTS DividendCoverage (Symbol TEXT NOT NULL, FirstDate TEXT NOT NULL, LastDate TEXT NOT NULL, PRIMARY KEY(Symbol))")
+        conn.commit()
+        conn.close()
+        cls.db_path = full_file_path
+        logger.info("Cache DB %s ready", full_file_path)
+
+    @classmethod
+    def __open_yh_cache(cls):
+        """
+        Returns the calling thread's connection to the cache DB. The connection
+        is opened on first use and kept open for the life of the thread.
+        :return: Database connection.
+        """
+        conn = cls._connections.get(threading.get_ident())
+        if conn:
+            return conn
+
+        with cls._lock:
+            if not cls.db_path:
+                cls.__init_yh_cache()
+            cls.__close_dead_connections()
+
+            # check_same_thread is off only so connections can be closed by another
+            # thread: those of ended threads by __close_dead_connections() and all
+            # of them by close_all() at exit. Otherwise a connection is used only
+            # by its own thread.
+            conn = sqlite3.connect(cls.db_path, timeout=cls.busy_timeout_ms / 1000.0,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA busy_timeout = {0}".format(cls.busy_timeout_ms))
+            conn.execute("PRAGMA cache_size = {0}".format(cls.page_cache_size))
+            conn.execute("PRAGMA mmap_size = {0}".format(cls.mmap_size))
+            # With WAL, NORMAL sync is safe against corruption and much faster
+            conn.execute("PRAGMA synchronous = NORMAL")
 
-        # We use the row factory to get named row columns. Makes handling row sets easier.
-        conn.row_factory = sqlite3.Row
-        # The default string type is unicode. This changes it to UTF-8.
-        conn.text_factory = str
+            # We use the row factory to get named row columns. Makes handling row sets easier.
+            conn.row_factory = sqlite3.Row
+            # The default string type is unicode. This changes it to UTF-8.
+            conn.text_factory = str
+            cls._connections[threading.get_ident()] = conn
+            logger.debug("Opened cache DB connection for thread %d", threading.get_ident())
 
         # return connection to the cache DB
         return conn
 
     @classmethod
+    def __close_dead_connections(cls):
+        """
+        Close connections owned by threads that have ended. Must be called
+        while holding the lock.
+        :return: None
+        """
+        live = set([t.ident for t in threading.enumerate()])
+        for ident in [i for i in cls._connections.keys() if i not in live]:
+            cls._connections.pop(ident).close()
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close every open cache DB connection. Registered to run at exit, so the
+        write-ahead log is checkpointed when the last connection closes.
+        :return: None
+        """
+        with cls._lock:
+            for conn in cls._connections.values():
+                try:
+                    conn.close()
+                except Exception as ex:
+                    logger.error("Unable to close cache DB connection: %s", str(ex))
+            cls._connections = {}
+
+    @classmethod
+    @metrics.timed("cachedb.lookup_closing_price_by_date")
     def lookup_closing_price_by_date(cls, symbol, tgtdate):
         """
         Look up cached historical data for a given symbol/date pair.
@@ -77,63 +187,207 @@ class CacheDB:
         if not cache_enabled:
             return None
         conn = cls.__open_yh_cache()
-        rset = conn.execute("SELECT * from SymbolDate where Symbol=? and Date=?", [symbol, tgtdate])
+        rset = conn.execute(SELECT_CLOSING_PRICE, [symbol, tgtdate])
         r = rset.fetchone()
-        conn.close()
         # r will be None if no record was found
         return r
 
     @classmethod
-    def insert_closing_price(cls, symbol, tgtdate, close):
+    @metrics.timed("cachedb.lookup_closing_prices_in_range")
+    def lookup_closing_prices_in_range(cls, symbol, start_date, end_date):
         """
-        Insert a new cache record in the cache DB. The Google service does not
-        produce all data values for every symbol (e.g. mutual funds only have closing prices).
-        to preserve backward compatiblity in the cache DB zero values are used for unavailable values.
+        Look up cached closing prices for a symbol over a date range.
         :param symbol:
-        :param tgtdate:
-        :param close:
-        :return:
+        :param start_date: First date (inclusive)
+        :param end_date: Last date (inclusive)
+        :return: List of records with Date and Close in date order.
+        """
+        if not cache_enabled:
+            return []
+        conn = cls.__open_yh_cache()
+        return conn.execute(SELECT_CLOSING_PRICE_RANGE, [symbol, start_date, end_date]).fetchall()
+
+    @classmethod
+    @metrics.timed("cachedb.lookup_daily_bars")
+    def lookup_daily_bars(cls, symbol):
+        """
+        Look up every cached daily bar of a symbol.
+        :param symbol:
+        :return: List of SymbolDate records in date order.
+        """
+        if not cache_enabled:
+            return []
+        conn = cls.__open_yh_cache()
+        return conn.execute(SELECT_DAILY_BARS, [symbol]).fetchall()
+
+    @classmethod
+    @metrics.timed("cachedb.lookup_coverage")
+    def lookup_coverage(cls, symbol):
+        """
+        Look up the interval of dates for which every trading day of a symbol is cached.
+        :param symbol:
+        :return: Record with FirstDate and LastDate. If no record is found, returns None.
         """
         if not cache_enabled:
             return None
         conn = cls.__open_yh_cache()
-        # print ("Cache data:", symbol, tgtdate, close)
-        conn.execute("INSERT INTO SymbolDate values (?,?,?,?,?,?,?,?)", [symbol, tgtdate, 0, 0, 0, close, 0, 0])
-        conn.commit()
-        conn.close()
+        return conn.execute(SELECT_COVERAGE, [symbol]).fetchone()
 
     @classmethod
-    def lookup_ttm_dividend_by_date(cls, symbol, tgtdate):
+    def update_coverage(cls, symbol, first_date, last_date):
         """
-        Look up cached historical data for a given symbol/date pair.
+        Record the interval of dates for which every trading day of a symbol is cached.
         :param symbol:
-        :param tgtdate:
-        :return: Returns the cached DB record. If no record is found, returns None.
+        :param first_date:
+        :param last_date:
+        :return: None
         """
         if not cache_enabled:
             return None
         conn = cls.__open_yh_cache()
-        rset = conn.execute("SELECT * from TTMDividends where Symbol=? and CalcDate=?", [symbol, tgtdate])
-        r = rset.fetchone()
-        conn.close()
-        # r will be None if no record was found
-        return r
+        with conn:
+            conn.execute(INSERT_COVERAGE, [symbol, first_date, last_date])
 
     @classmethod
-    def insert_ttm_dividend(cls, symbol, tgtdate, dividend):
+    def insert_daily_bars(cls, symbol, bars):
         """
-        Insert a new cache record in the cache DB. The Google service does not
-        produce all data values for every symbol (e.g. mutual funds only have closing prices).
-        to preserve backward compatiblity in the cache DB zero values are used for unavailable values.
+        Insert many daily bars for a symbol in a single transaction.
+        Existing records for the same dates are replaced.
         :param symbol:
-        :param tgtdate:
-        :param close:
-        :return:
+        :param bars: Iterable of (date, open, high, low, close, volume, adj_close) tuples.
+        :return: The number of records written.
+        """
+        if not cache_enabled:
+            return 0
+        conn = cls.__open_yh_cache()
+        rows = [[symbol] + list(bar) for bar in bars]
+        with conn:
+            conn.executemany(INSERT_CLOSING_PRICE, rows)
+        return len(rows)
+
+    @classmethod
+    @metrics.timed("cachedb.lookup_result_blob")
+    def lookup_result_blob(cls, category, cache_key):
+        """
+        Look up a cached result that has not passed its retention time.
+        :param category: Result category (e.g. quote)
+        :param cache_key:
+        :return: Record with Expiration, RetainUntil and Payload. If no record is found, returns None.
         """
         if not cache_enabled:
             return None
         conn = cls.__open_yh_cache()
-        # print ("Cache data:", symbol, tgtdate, close)
-        conn.execute("INSERT INTO TTMdividends values (?,?,?)", [symbol, tgtdate, dividend])
-        conn.commit()
-        conn.close()
+        return conn.execute(SELECT_RESULT_BLOB, [category, cache_key, time.time()]).fetchone()
+
+    @classmethod
+    def insert_result_blobs(cls, category, blobs):
+        """
+        Insert or replace cached results in a single transaction. Expired
+        results are purged at most once every purge_interval seconds.
+        :param category: Result category (e.g. quote)
+        :param blobs: Iterable of (cache_key, expiration, retain_until, payload) tuples.
+        :return: None
+        """
+        if not cache_enabled:
+            return None
+        conn = cls.__open_yh_cache()
+        now = time.time()
+        with conn:
+            conn.executemany(INSERT_RESULT_BLOB, [[category] + list(b) for b in blobs])
+            if now >= cls._next_purge:
+                # Results that can no longer be used
+                cls._next_purge = now + cls.purge_interval
+                rows = conn.execute(DELETE_RESULT_BLOBS, [now]).rowcount
+                if rows:
+                    logger.debug("Purged %d expired cached results", rows)
+
+    @classmethod
+    @metrics.timed("cachedb.lookup_result_keys")
+    def lookup_result_keys(cls, category):
+        """
+        Look up the item keys discovered for a result category.
+        :param category: Result category (e.g. quote)
+        :return: Record with Keys as a JSON list. If no record is found, returns None.
+        """
+        if not cache_enabled:
+            return None
+        conn = cls.__open_yh_cache()
+        return conn.execute(SELECT_RESULT_KEYS, [category]).fetchone()
+
+    @classmethod
+    def insert_result_keys(cls, category, keys):
+        """
+        Insert or replace the item keys of a result category.
+        :param category: Result category (e.g. quote)
+        :param keys: JSON list of keys
+        :return: None
+        """
+        if not cache_enabled:
+            return None
+        conn = cls.__open_yh_cache()
+        with conn:
+            conn.execute(INSERT_RESULT_KEYS, [category, keys])
+
+    @classmethod
+    def insert_dividends(cls, symbol, dividends):
+        """
+        Insert many dividends for a symbol in a single transaction.
+        Existing records for the same ex-dates are replaced.
+        :param symbol:
+        :param dividends: Iterable of (ex_date, amount, payment_date, record_date, declared_date) tuples.
+        :return: The number of records written.
+        """
+        if not cache_enabled:
+            return 0
+        conn = cls.__open_yh_cache()
+        rows = [[symbol] + list(d) for d in dividends]
+        with conn:
+            conn.executemany(INSERT_DIVIDEND, rows)
+        return len(rows)
+
+    @classmethod
+    @metrics.timed("cachedb.sum_dividends_in_range")
+    def sum_dividends_in_range(cls, symbol, after_date, end_date):
+        """
+        Sum the cached dividends of a symbol with an ex-date in a date range.
+        :param symbol:
+        :param after_date: First date (exclusive)
+        :param end_date: Last date (inclusive)
+        :return: Total amount. 0.0 if there are no dividends in the range.
+        """
+        if not cache_enabled:
+            return 0.0
+        conn = cls.__open_yh_cache()
+        return conn.execute(SUM_DIVIDENDS_IN_RANGE, [symbol, after_date, end_date]).fetchone()[0]
+
+    @classmethod
+    @metrics.timed("cachedb.lookup_dividend_coverage")
+    def lookup_dividend_coverage(cls, symbol):
+        """
+        Look up the interval of ex-dates for which every dividend of a symbol is cached.
+        :param symbol:
+        :return: Record with FirstDate and LastDate. If no record is found, returns None.
+        """
+        if not cache_enabled:
+            return None
+        conn = cls.__open_yh_cache()
+        return conn.execute(SELECT_DIVIDEND_COVERAGE, [symbol]).fetchone()
+
+    @classmethod
+    def update_dividend_coverage(cls, symbol, first_date, last_date):
+        """
+        Record the interval of ex-dates for which every dividend of a symbol is cached.
+        :param symbol:
+        :param first_date:
+        :param last_date:
+        :return: None
+        """
+        if not cache_enabled:
+            return None
+        conn = cls.__open_yh_cache()
+        with conn:
+            conn.execute(INSERT_DIVIDEND_COVERAGE, [symbol, first_date, last_date])
+
+
+# Close the cache DB when LibreOffice shuts down the Python runtime
+atexit.register(CacheDB.close_all)
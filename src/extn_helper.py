@@ -21,8 +21,17 @@
 #
 
 import datetime
+import functools
 
+# Calc serial date 0.0 (1899-12-30) as a date.toordinal() value
+serial_date_base = 693594
+# 1970-01-01 (day 0 of numpy.datetime64) as a date.toordinal() value
+epoch_ordinal = 719163
+# Ranges with at least this many serial dates are converted with NumPy (if available)
+vectorize_min_length = 64
 
+
+@functools.lru_cache(maxsize=4096)
 def float_to_date_str(float_date):
     """
     Magic algorithm to convert float date
@@ -32,13 +41,8 @@ def float_to_date_str(float_date):
     :param float_date: ddddd.tttttt where d is days from 1899-12-31 and .tttttt is fraction of 24 hours
     :return:
     """
-    # 25569 = number of days from 1899-12-30 to 1970-1-1
-    # 86400 = number of seconds in a day
-    # seconds = number of seconds from 1970-1-1 00:00:00
-    seconds = (int(float_date) - 25569) * 86400
-    d = datetime.datetime.utcfromtimestamp(seconds)
-    eff_date = d.strftime("%Y-%m-%d")
-    return eff_date
+    # The whole days are an offset from the proleptic Gregorian ordinal of 1899-12-30
+    return datetime.date.fromordinal(int(float_date) + serial_date_base).isoformat()
 
 def date_str_to_float(date_str):
     """
@@ -56,9 +60,11 @@ def date_str_to_float(date_str):
     # since 1899-12-31 and .tttttt is the fractional portion of a day.
     return float_date
 
+@functools.lru_cache(maxsize=4096, typed=True)
 def normalize_date(tgtdate):
     """
-    Normalize an LO Calc date to an ISO formatted string
+    Normalize an LO Calc date to an ISO formatted string. Results are
+    memoized on the raw cell value since sheets repeat the same dates.
     :param tgtdate: The date can be a float or a string. Floats are
     in an Excel format (see float_to_date-str() above). Strings are
     in ISO format YYYYY-MM-DD or US format m/d/yy.
@@ -67,9 +73,20 @@ def normalize_date(tgtdate):
     if type(tgtdate) == float:
         if tgtdate == 0.0:
             return None
-        return float_to_date_str(tgtdate)
+        try:
+            return float_to_date_str(tgtdate)
+        except (ValueError, OverflowError):
+            # NaN, infinite or outside years 1-9999
+            pass
     elif type(tgtdate) == str and tgtdate != "":
         # Assumed to be a string in ISO format (YYYY-MM-DD).
+        if len(tgtdate) == 10 and tgtdate[4] == "-" and tgtdate[7] == "-" and \
+                tgtdate[0:4].isdigit() and tgtdate[5:7].isdigit() and tgtdate[8:10].isdigit():
+            try:
+                datetime.date(int(tgtdate[0:4]), int(tgtdate[5:7]), int(tgtdate[8:10]))
+                return tgtdate
+            except ValueError:
+                pass
         try:
             dt = datetime.datetime.strptime(tgtdate, "%Y-%m-%d")
             return tgtdate
@@ -86,6 +103,80 @@ def normalize_date(tgtdate):
 
     raise ValueError("Unsupported date format type: {0} value: {1}".format(type(tgtdate), tgtdate))
 
+def normalize_dates(cell_range, invalid=None):
+    """
+    Normalize a LO Calc cell range of dates. Every value is normalized
+    exactly as normalize_date() would normalize it. When a range holds many
+    serial dates they are converted together as a NumPy array.
+    :param cell_range: Range (tuple of row tuples) or a single cell value.
+    :param invalid: Value given for a date that normalize_date() rejects.
+    :return: List of row lists with the shape of the range.
+    """
+    if not isinstance(cell_range, (tuple, list)):
+        cell_range = ((cell_range,),)
+    rows = [list(row) if isinstance(row, (tuple, list)) else [row] for row in cell_range]
+
+    # Positions of the serial dates
+    serials = [(r, c) for r, row in enumerate(rows) for c, v in enumerate(row)
+               if type(v) == float and v != 0.0]
+    numpy = _numpy() if len(serials) >= vectorize_min_length else None
+
+    if numpy is not None:
+        days = numpy.array([rows[r][c] for r, c in serials], dtype=numpy.float64)
+        finite = numpy.isfinite(days)
+        # int() truncates toward zero, as numpy.trunc does
+        ordinals = numpy.where(finite, numpy.trunc(numpy.where(finite, days, 0.0)), 0.0) + serial_date_base
+        valid = finite & (ordinals >= 1) & (ordinals <= datetime.date.max.toordinal())
+        iso_dates = (numpy.where(valid, ordinals, epoch_ordinal).astype(numpy.int64) - epoch_ordinal) \
+            .astype("datetime64[D]").astype(str).tolist()
+        for (r, c), ok, iso_date in zip(serials, valid.tolist(), iso_dates):
+            rows[r][c] = iso_date if ok else invalid
+        serials = set(serials)
+
+    for r, row in enumerate(rows):
+        for c, v in enumerate(row):
+            if numpy is not None and (r, c) in serials:
+                continue
+            try:
+                row[c] = normalize_date(v)
+            except (ValueError, TypeError):
+                row[c] = invalid
+    return rows
+
+def _numpy():
+    """
+    Returns the numpy module or None if it is not available. It is
+    imported on first use to keep it out of extension start up.
+    """
+    try:
+        import numpy
+        return numpy
+    except Exception:
+        return None
+
+def flatten_range(cell_range):
+    """
+    Flatten a LO Calc cell range into a list of strings. A range arrives
+    as a tuple of row tuples. A single cell may arrive as a plain value.
+    :param cell_range: Range or cell value.
+    :return: List of stripped strings in row order. Empty cells are empty strings.
+    """
+    if not isinstance(cell_range, (tuple, list)):
+        cell_range = ((cell_range,),)
+    values = []
+    for row in cell_range:
+        if not isinstance(row, (tuple, list)):
+            row = (row,)
+        for v in row:
+            if v is None:
+                values.append("")
+            elif isinstance(v, float) and v.is_integer():
+                # Numbers come from LO Calc as floats
+                values.append(str(int(v)))
+            else:
+                values.append(str(v).strip())
+    return values
+
 def normalize_frequency(frequency):
     """
     Normalize frequency to account for the way LO Calc delivers empty cells
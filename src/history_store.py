@@ -0,0 +1,285 @@
+#
+# history_store - Memory-mapped columnar store of daily price history
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Each symbol has a folder holding two NumPy files:
+#   dates.npy   int32 days (date.toordinal()) in ascending order
+#   bars.npy    float64 array of shape (6, n). One row (column of the
+#               history) each for open, high, low, close, volume and adj close.
+#   coverage.npy  int32 first and last days for which every trading day is
+#               stored (the same interval as SymbolCoverage in the cache DB)
+# The files are memory-mapped, so a lookup is a binary search on the dates
+# and a range is a slice of the mapped arrays. The SQLite cache DB remains
+# the cache of record. This store is an optional index over it.
+#
+
+import os
+import functools
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import date
+from iex_app_logger import AppLogger
+from iex_lib import QConfiguration
+
+# Logger init
+the_app_logger = AppLogger("iex-extension")
+logger = the_app_logger.getAppLogger()
+
+# If NumPy is not available, disable the store
+try:
+    import numpy
+    numpy_available = True
+except Exception as ex:
+    numpy_available = False
+    logger.info("numpy unavailable; history store disabled")
+
+# Row of each item in bars.npy. The names are the SymbolDate columns.
+bar_columns = ["Open", "High", "Low", "Close", "Volume", "Adj_Close"]
+
+
+class HistoryStore:
+    # Symbols whose files are kept mapped. Each mapped symbol holds two open files.
+    max_mapped_symbols = 256
+    # {symbol: (dates, bars, coverage)} in least recently used order
+    _mapped = OrderedDict()
+    _lock = threading.Lock()
+    # {symbol: lock} serializing the read-merge-write of each symbol's files
+    _write_locks = {}
+
+    @classmethod
+    def enabled(cls):
+        return numpy_available and QConfiguration.history_store
+
+    @classmethod
+    def _symbol_path(cls, symbol):
+        return os.path.join(os.path.expanduser(QConfiguration.history_store_path), symbol)
+
+    @classmethod
+    def _load(cls, symbol):
+        """
+        Returns the mapped (dates, bars) arrays of a symbol and its coverage.
+        :param symbol: Upper case ticker symbol
+        :return: Tuple (dates, bars, coverage) or None if the symbol is not stored
+        """
+        with cls._lock:
+            arrays = cls._mapped.get(symbol)
+            if arrays is not None:
+                cls._mapped.move_to_end(symbol)
+                return arrays
+
+        path = cls._symbol_path(symbol)
+        try:
+            dates = numpy.load(os.path.join(path, "dates.npy"), mmap_mode="r")
+            bars = numpy.load(os.path.join(path, "bars.npy"), mmap_mode="r")
+            coverage = numpy.load(os.path.join(path, "coverage.npy"))
+        except (IOError, OSError, ValueError):
+            return None
+        if dates.shape[0] != bars.shape[1]:
+            # Caught between the moves of _replace. The cache DB will answer.
+            logger.debug("History store for %s is being replaced", symbol)
+            return None
+
+        arrays = (dates, bars, (int(coverage[0]), int(coverage[1])))
+        with cls._lock:
+            cls._mapped[symbol] = arrays
+            while len(cls._mapped) > cls.max_mapped_symbols:
+                cls._mapped.popitem(last=False)
+        return arrays
+
+    @classmethod
+    def lookup_bar(cls, symbol, for_date):
+        """
+        Look up the daily bar of a symbol on a date.
+        :param symbol: Upper case ticker symbol
+        :param for_date: ISO format date YYYY-MM-DD
+        :return: Dict with SymbolDate column names as keys or None if the date is not stored.
+        """
+        if not cls.enabled():
+            return None
+        arrays = cls._load(symbol)
+        if arrays is None:
+            return None
+        dates, bars, coverage = arrays
+        day = _to_days(for_date)
+        i = int(numpy.searchsorted(dates, day))
+        if i >= dates.shape[0] or dates[i] != day:
+            return None
+        r = dict(zip(bar_columns, bars[:, i].tolist()))
+        r["Symbol"] = symbol
+        r["Date"] = for_date
+        r["Volume"] = int(r["Volume"])
+        return r
+
+    @classmethod
+    def lookup_range(cls, symbol, start_date, end_date):
+        """
+        Returns the stored history of a symbol over a date range. The arrays
+        are slices of the mapped files, not copies.
+        :param symbol: Upper case ticker symbol
+        :param start_date: First date (inclusive) YYYY-MM-DD
+        :param end_date: Last date (inclusive) YYYY-MM-DD
+        :return: Tuple (dates, bars) or None if the symbol is not stored
+        """
+        if not cls.enabled():
+            return None
+        arrays = cls._load(symbol)
+        if arrays is None:
+            return None
+        dates, bars, coverage = arrays
+        first = int(numpy.searchsorted(dates, _to_days(start_date), side="left"))
+        last = int(numpy.searchsorted(dates, _to_days(end_date), side="right"))
+        return dates[first:last], bars[:, first:last]
+
+    @classmethod
+    def lookup_coverage(cls, symbol):
+        """
+        Look up the interval of dates for which every trading day of a symbol is stored.
+        :param symbol: Upper case ticker symbol
+        :return: Tuple (first, last) of ISO dates or None if the symbol is not stored
+        """
+        arrays = cls._load(symbol) if cls.enabled() else None
+        if arrays is None:
+            return None
+        coverage = arrays[2]
+        return to_iso_date(coverage[0]), to_iso_date(coverage[1])
+
+    @classmethod
+    def writer(cls, symbol):
+        """
+        Returns a writer that merges daily bars into a symbol's files.
+        :param symbol: Upper case ticker symbol
+        :return: HistoryWriter or None if the store is disabled.
+        """
+        if not cls.enabled():
+            return None
+        return HistoryWriter(symbol)
+
+    @classmethod
+    def _write_lock(cls, symbol):
+        """
+        Returns the lock held while a symbol's files are merged and replaced.
+        """
+        with cls._lock:
+            return cls._write_locks.setdefault(symbol, threading.Lock())
+
+    @classmethod
+    def _replace(cls, symbol, dates, bars, coverage):
+        """
+        Replace the files of a symbol. Each new file is written to a unique
+        temporary file next to the old one and moved into place. A reader
+        that opens the files between the moves finds their lengths differ
+        and uses the cache DB instead. The caller holds the symbol's write lock.
+        """
+        path = cls._symbol_path(symbol)
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        with cls._lock:
+            # Release our mapping of the old files (Windows can't replace a mapped file)
+            cls._mapped.pop(symbol, None)
+        for name, a in (("dates", dates), ("bars", bars), ("coverage", coverage)):
+            fd, tmp = tempfile.mkstemp(prefix=name + ".", suffix=".tmp", dir=path)
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    numpy.save(fh, a)
+                os.replace(tmp, os.path.join(path, name + ".npy"))
+            except Exception:
+                os.remove(tmp)
+                raise
+
+
+class HistoryWriter:
+    """
+    Collects daily bars for a symbol and merges them into its stored history.
+    Bars are kept as compact arrays, not tuples, until commit().
+    """
+    def __init__(self, symbol):
+        self.symbol = symbol
+        self._dates = []
+        self._bars = []
+
+    def add(self, bars):
+        """
+        :param bars: Iterable of (date, open, high, low, close, volume, adj_close)
+        :return: None
+        """
+        bars = list(bars)
+        if not bars:
+            return
+        self._dates.append(numpy.array([_to_days(b[0]) for b in bars], dtype=numpy.int32))
+        self._bars.append(numpy.array([b[1:] for b in bars], dtype=numpy.float64).T)
+
+    def commit(self, first_date, last_date):
+        """
+        Merge the collected bars into the stored history. Collected bars replace
+        stored bars with the same date.
+        :param first_date: First date of the interval the bars cover
+        :param last_date: Last date of the interval the bars cover. The interval
+        is merged into the stored coverage as SymbolCoverage is in the cache DB.
+        :return: Number of bars stored for the symbol
+        """
+        if not self._dates:
+            return 0
+        with HistoryStore._write_lock(self.symbol):
+            return self._merge(first_date, last_date)
+
+    def _merge(self, first_date, last_date):
+        """
+        Merge the collected bars with the stored history and replace the
+        symbol's files. Called with the symbol's write lock held.
+        """
+        dates = numpy.concatenate(self._dates)
+        bars = numpy.concatenate(self._bars, axis=1)
+        coverage = (_to_days(first_date), _to_days(last_date))
+        old = HistoryStore._load(self.symbol)
+        if old is not None:
+            if old[2][1] >= coverage[0] and old[2][0] <= coverage[1]:
+                # The last date of the new bars is the newest that has been published
+                coverage = (min(coverage[0], old[2][0]), coverage[1])
+            # New bars first so numpy.unique keeps them over old bars for the same date
+            dates = numpy.concatenate((dates, old[0]))
+            bars = numpy.concatenate((bars, old[1]), axis=1)
+            # Drop the mapping of the old files before they are replaced
+            old = None
+        dates, index = numpy.unique(dates, return_index=True)
+        bars = numpy.ascontiguousarray(bars[:, index])
+        try:
+            HistoryStore._replace(self.symbol, dates.astype(numpy.int32), bars,
+                                  numpy.array(coverage, dtype=numpy.int32))
+        except Exception as ex:
+            logger.error("Unable to update history store for %s: %s", self.symbol, str(ex))
+            return 0
+        logger.debug("History store for %s has %d bars", self.symbol, dates.shape[0])
+        return dates.shape[0]
+
+
+@functools.lru_cache(maxsize=8192)
+def to_iso_date(days):
+    """
+    Converts a day number from dates.npy to an ISO date. The same few
+    thousand trading days recur for every symbol, so conversions are memoized.
+    :param days: date.toordinal()
+    :return: YYYY-MM-DD
+    """
+    return date.fromordinal(days).isoformat()
+
+
+def _to_days(iso_date):
+    """
+    Converts an ISO date to the int32 day number used in dates.npy.
+    :param iso_date: YYYY-MM-DD
+    :return: date.toordinal()
+    """
+    return date(int(iso_date[0:4]), int(iso_date[5:7]), int(iso_date[8:10])).toordinal()
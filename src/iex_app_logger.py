@@ -12,13 +12,20 @@
 import logging
 import logging.handlers
 import os
+import queue
+import atexit
 
 
 class AppLogger:
     # All of the created loggers
     logger_list = []
+    # File handler of each logger
+    file_handlers = {}
+    # Background writers of loggers in queued mode
+    queue_listeners = {}
 
     def __init__(self, logname):
+        self.logname = logname
         self.logger = None
         self.EnableLogging(logname)
 
@@ -56,6 +63,7 @@ class AppLogger:
             fh = logging.handlers.TimedRotatingFileHandler(logfile, when='midnight', backupCount=3)
             fh.setFormatter(formatter)
             self.logger.addHandler(fh)
+            AppLogger.file_handlers[logname] = fh
             self.logger.debug("New logger %s created: %s", logname, str(self.logger))
             self.logger.debug("%s logging to file: %s", logname, logfile)
 
@@ -89,7 +97,51 @@ class AppLogger:
         self.logger.setLevel(loglevel_setting)
         self.logger.debug("Log level set to %s", loglevel)
 
+    def set_queued_logging(self, queued):
+        """
+        Choose how log records reach the log file. In queued mode the calling
+        thread only puts the record on a queue and a background thread
+        does the file writing. Otherwise records are written on the calling thread.
+        :param queued: True for queued mode.
+        :return: None
+        """
+        fh = AppLogger.file_handlers.get(self.logname)
+        if fh is None or queued == (self.logname in AppLogger.queue_listeners):
+            return
+
+        if queued:
+            q = queue.Queue(-1)
+            listener = logging.handlers.QueueListener(q, fh, respect_handler_level=True)
+            listener.start()
+            AppLogger.queue_listeners[self.logname] = listener
+            qh = logging.handlers.QueueHandler(q)
+            self.logger.addHandler(qh)
+            self.logger.removeHandler(fh)
+        else:
+            self.logger.addHandler(fh)
+            for h in list(self.logger.handlers):
+                if isinstance(h, logging.handlers.QueueHandler):
+                    self.logger.removeHandler(h)
+            # Writes out whatever is still queued
+            AppLogger.queue_listeners.pop(self.logname).stop()
+        self.logger.debug("Queued logging %s", "on" if queued else "off")
+
+    @classmethod
+    def stop_queue_listeners(cls):
+        """
+        Write out any queued log records and stop the background writers.
+        :return: None
+        """
+        for listener in cls.queue_listeners.values():
+            listener.stop()
+        cls.queue_listeners.clear()
+
     # Controlled logging shutdown
     def Shutdown(self):
         self.getAppLogger().debug("Logging shutdown")
+        AppLogger.stop_queue_listeners()
         logging.shutdown()
+
+
+# Queued records must be written before the log file is closed
+atexit.register(AppLogger.stop_queue_listeners)
@@ -16,9 +16,12 @@
 #
 
 from iex_app_logger import AppLogger
-from datetime import datetime, timedelta
-from url_helpers import exec_request
+from datetime import datetime
+from url_helpers import exec_request, exec_request_stream
 from iex_lib import QConfiguration
+from iex_cache import SingleFlight, ResultCache, Revalidator, TieredCache
+from iex_schema import schema_registry
+from iex_metrics import metrics
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -28,17 +31,29 @@ class IEXBase:
     """
     
     """
-    def __init__(self):
-        # This list is used to validate requested item keys
-        self.result_keys = None
-        # Cache organization
-        # {"ticker": {"expiration": datetime, "result": {}}}
-        self.result_cache = {}
+    # Maximum number of symbols IEX accepts in one market batch call
+    batch_symbol_limit = 100
+    # Shared by all categories. Concurrent fetches of the same
+    # (category, cache key) are collapsed into one IEX call.
+    single_flight = SingleFlight()
+    # Shared by all categories. Refreshes stale results in the background.
+    revalidator = Revalidator()
+
+    def __init__(self, category=None):
+        # Result category (e.g. quote). Used for messages and to key in-flight
+        # requests and persistently cached results.
+        self.category = category
+        # Results keyed by ticker (or ticker and range). A bounded LRU cache in
+        # memory backed by the cache DB.
+        self.result_cache = TieredCache(category,
+                                        ResultCache(max_entries=QConfiguration.cache_max_entries,
+                                                    max_bytes=QConfiguration.cache_max_bytes))
         # Keys that require time conversion
         self.time_keys = []
         logger.debug("IEXBase initialized")
-        # Ticker symbol to use as a template
-        self.template_symbol = "ibm"
+        # IEX market batch type for this result (e.g. quote). None means the
+        # result can't be fetched through the market batch API.
+        self.batch_type = None
 
     @staticmethod
     def _get_formatted_datetime(unix_time_ms):
@@ -59,21 +74,117 @@ class IEXBase:
         :param cache_key: The key value for the cache entry.
         :return: Returns None if no cached result is available.
         """
-        if (cache_key in self.result_cache) and (self.result_cache[cache_key]["expiration"] > datetime.now()):
-            return self.result_cache[cache_key]["result"]
-        return None
+        return self.result_cache.get(cache_key)
     
     def _cache_result(self, cache_key, result):
         """
         Add a result to the cache. An existing result for a symbol is replaced.
-        A cached quote has a "time-to-live" (TTL) value after which it is considered
-        stale or invalid.
+        A cached result has a "time-to-live" (TTL) value after which it is considered
+        stale or invalid. The TTL is configured by category (see QConfiguration.cache_ttl).
         :param cache_key: The key value for the cache entry.
         :param result: The value to be cached.
         :return:
         """
-        # Quote expires in 5 minutes. TODO Consider making this a config value.
-        self.result_cache[cache_key] = {"expiration":datetime.now() + timedelta(minutes=5), "result":result}
+        self.result_cache.put(cache_key, result, QConfiguration.get_cache_ttl(self.category),
+                              grace=QConfiguration.get_stale_grace(self.category))
+        self._observe_result_keys(result["result"])
+
+    def get_cache_stats(self):
+        """
+        Returns the size, eviction counts and hits by cache tier of the result cache.
+        :return: dict
+        """
+        return self.result_cache.stats()
+
+    def _cache_results(self, results):
+        """
+        Add many results to the cache.
+        :param results: dict of cache key: result
+        :return:
+        """
+        self.result_cache.put_many(results, QConfiguration.get_cache_ttl(self.category),
+                                   grace=QConfiguration.get_stale_grace(self.category))
+        for result in results.values():
+            self._observe_result_keys(result["result"])
+
+    def _observe_result_keys(self, result):
+        """
+        Tell the schema registry about the keys in a result returned by IEX.
+        :param result: The result key value of an IEX response.
+        :return:
+        """
+        keys = self._extract_result_keys(result)
+        if keys:
+            schema_registry.observe(self.category, keys)
+
+    def _extract_result_keys(self, result):
+        """
+        Returns the item keys in a result. Derived classes whose items are
+        not at the top level of the result override this method.
+        :param result: The result key value of an IEX response.
+        :return: Iterable of keys or None
+        """
+        if isinstance(result, dict):
+            return result.keys()
+        return None
+
+    def _get_cached_or_fetch(self, cache_key, fetch):
+        """
+        Returns the cached result for a cache key. On a cache miss the result
+        is fetched, cached (if the fetch succeeded) and returned. Concurrent
+        callers missing the same cache key share a single fetch.
+        If stale-while-revalidate is configured for the category, an expired
+        result within its grace period is returned immediately and refreshed
+        in the background.
+        :param cache_key: The key value for the cache entry.
+        :param fetch: Function with no arguments that calls IEX for the result.
+        :return: The result dict.
+        """
+        entry = self.result_cache.get_entry(cache_key)
+        if entry:
+            res, fresh = entry
+            if fresh:
+                metrics.increment("cache.{0}.hits".format(self.category))
+                logger.debug("%s cache hit for %s", self.category, cache_key)
+            else:
+                metrics.increment("cache.{0}.stale".format(self.category))
+                logger.debug("%s stale cache hit for %s", self.category, cache_key)
+                self._revalidate(cache_key, fetch)
+            return res
+        metrics.increment("cache.{0}.misses".format(self.category))
+
+        def fetch_and_cache():
+            # The cache may have been filled while this caller was getting here.
+            # Level 2 was just checked and a fill reaches level 1 first.
+            res = self.result_cache.get_l1(cache_key)
+            if res:
+                return res
+            logger.debug("%s cache miss for %s", self.category, cache_key)
+            res = fetch()
+            if res["status_code"] == 200:
+                self._cache_result(cache_key, res)
+                logger.debug("%s cached for %s", self.category, cache_key)
+            return res
+
+        return IEXBase.single_flight.do((self.category, cache_key), fetch_and_cache)
+
+    def _revalidate(self, cache_key, fetch):
+        """
+        Refresh a stale result in the background. The cache entry is replaced
+        only if the refresh succeeds.
+        :param cache_key: The key value for the cache entry.
+        :param fetch: Function with no arguments that calls IEX for the result.
+        :return: None
+        """
+        def refresh():
+            res = fetch()
+            if res["status_code"] == 200:
+                self._cache_result(cache_key, res)
+                logger.debug("%s refreshed for %s", self.category, cache_key)
+            return res
+
+        IEXBase.revalidator.schedule((self.category, cache_key),
+                                     lambda: IEXBase.single_flight.do((self.category, cache_key), refresh))
 
     # TODO The dervived class must override this method
     def _get_result_for_symbol(self, symbol):
@@ -87,19 +198,50 @@ class IEXBase:
         logger.debug("_get_result_for_symbol was not overriden")
         return None
     
+    def prefetch_results(self, symbols):
+        """
+        Fetch results for a list of symbols using the IEX market batch API.
+        Symbols that already have a cached result are skipped. The remaining
+        symbols are fetched in chunks of batch_symbol_limit and each symbol's
+        result is cached as if it had been fetched individually.
+        :param symbols: List of stock ticker symbols.
+        :return: The number of symbols that were fetched and cached.
+        """
+        if not self.batch_type:
+            return 0
+
+        # Unique, upper case symbols that are not already cached
+        missing = []
+        for symbol in symbols:
+            symbol = symbol.upper()
+            if symbol and symbol not in missing and not self._get_cached_result(symbol):
+                missing.append(symbol)
+
+        fetched = 0
+        for i in range(0, len(missing), IEXBase.batch_symbol_limit):
+            chunk = missing[i:i + IEXBase.batch_symbol_limit]
+            res = IEXBase.exec_batch_request(chunk, [self.batch_type])
+            if res["status_code"] != 200:
+                logger.error("Batch %s request failed for %d symbols: %s", self.batch_type, len(chunk),
+                             res.get("error_message", ""))
+                continue
+            # Unknown symbols are omitted from the batch result
+            results = {}
+            for symbol, types in res["result"].items():
+                if self.batch_type in types:
+                    results[symbol.upper()] = {"result": types[self.batch_type], "status_code": 200}
+            self._cache_results(results)
+            fetched += len(results)
+            logger.debug("Batch %s cached %d of %d symbols", self.batch_type, len(res["result"]), len(chunk))
+        return fetched
+
     def _get_result_keys(self):
         """
-        Return the list of keys in a result.
+        Return the list of keys in a result. The keys come from the schema
+        registry, so no IEX call is required.
         :return:
         """
-        if not self.result_keys:
-            res = self._get_result_for_symbol(self.template_symbol)
-            if res["status_code"] != 200:
-                return None
-            # Sort keys case insensitive. Avoids randomized list of keys.
-            self.result_keys = list(res["result"].keys())
-            self.result_keys.sort(key=lambda k: k.lower())
-        return self.result_keys
+        return schema_registry.get_keys(self.category)
     
     def _is_valid_result_key(self, key):
         """
@@ -107,18 +249,14 @@ class IEXBase:
         :param key:
         :return:
         """
-        keys = self._get_result_keys()
-        return key in keys
+        return schema_registry.is_valid_key(self.category, key)
 
     def get_result_key_count(self):
         """
         Returns the number of keys in a result.
         :return:
         """
-        res = self._get_result_for_symbol(self.template_symbol)
-        if res["status_code"] == 200:
-            return len(res["result"])
-        return res["error_message"]
+        return len(self._get_result_keys())
 
     def get_result_keyx(self, index):
         """
@@ -145,24 +283,70 @@ class IEXBase:
         if self._is_valid_result_key(key):
             res = self._get_result_for_symbol(symbol)
             if res["status_code"] == 200:
-                # Apply time conversion as required
-                v = res["result"][key]
-                if key in self.time_keys:
-                    if v:
-                        # Convert IEX timestamp value to something human readable
-                        return IEXBase._get_formatted_datetime(v)
-                    else:
-                        return "NA"
-                elif isinstance(v, int) and (v > 2147483647 or v < -2147483648):
-                    # LO calc doesn't seem to handle large integers
-                    return float(v)
-                elif isinstance(v, list):
-                    # Easy out for a list
-                    return ', '.join(v)
-                return v
+                if key not in res["result"]:
+                    # A valid key that IEX did not return for this symbol
+                    return "NA"
+                return self._format_value(key, res["result"][key])
             return res["error_message"]
         return "Invalid {0} key".format(category)
 
+    def _format_value(self, key, v):
+        """
+        Convert a result value to something LO Calc can display.
+        :param key: The item key of the value.
+        :param v: The value from the IEX result.
+        :return: Converted value
+        """
+        # Apply time conversion as required
+        if key in self.time_keys:
+            if v:
+                # Convert IEX timestamp value to something human readable
+                return IEXBase._get_formatted_datetime(v)
+            else:
+                return "NA"
+        elif isinstance(v, int) and (v > 2147483647 or v < -2147483648):
+            # LO calc doesn't seem to handle large integers
+            return float(v)
+        elif isinstance(v, list):
+            # Easy out for a list
+            return ', '.join(v)
+        return v
+
+    def get_result_table(self, category, symbols, keys):
+        """
+        Returns a table of result items with a row for each symbol and a
+        column for each key. Symbols that are not cached are fetched with
+        as few IEX calls as possible.
+        :param category: URL category. Currently only used for messages.
+        :param symbols: List of stock ticker symbols. Empty entries produce an empty row.
+        :param keys: List of item keys. Empty entries produce an empty column.
+        :return: Tuple of row tuples
+        """
+        # Validate each key once rather than once per cell
+        valid_keys = [(k, (not k) or self._is_valid_result_key(k)) for k in keys]
+        self.prefetch_results([s for s in symbols if s])
+
+        rows = []
+        for symbol in symbols:
+            if not symbol:
+                rows.append(tuple(["" for k in keys]))
+                continue
+            res = self._get_result_for_symbol(symbol)
+            row = []
+            for key, valid in valid_keys:
+                if not key:
+                    row.append("")
+                elif not valid:
+                    row.append("Invalid {0} key".format(category))
+                elif res["status_code"] != 200:
+                    row.append(res["error_message"])
+                else:
+                    v = self._format_value(key, res["result"].get(key))
+                    # A null value can't be returned in an array
+                    row.append("" if v is None else v)
+            rows.append(tuple(row))
+        return tuple(rows)
+
     @staticmethod
     def _exec_request(url_string, parms=None):
         """
@@ -176,11 +360,38 @@ class IEXBase:
         j = exec_request(QConfiguration.base_url + url_string, parms)
         return j
 
+    @staticmethod
+    def _exec_request_stream(url_string, handle_item, parms=None):
+        """
+         Submit https request to IEX for a JSON array, handing each
+         element to handle_item as it arrives. See url_helpers.exec_request_stream.
+        :param url_string:
+        :param handle_item: Function called with each element of the array.
+        :param parms:
+        :return: Dict with the status_code and count (elements handled) keys.
+        """
+        return exec_request_stream(QConfiguration.base_url + url_string, parms, handle_item)
+
     @staticmethod
     def exec_stock_request(symbol, category, parms=None):
         url_string = "/stock/{0}/{1}".format(symbol.upper(), category)
         return IEXBase._exec_request(url_string, parms=parms)
 
+    @staticmethod
+    def exec_batch_request(symbols, types, parms=None):
+        """
+        Submit a market batch request to IEX
+        :param symbols: List of ticker symbols (at most batch_symbol_limit).
+        :param types: List of categories to be returned for each symbol (e.g. quote).
+        :param parms: Additional query parameters.
+        :return: A dict where the result key contains a dict keyed by symbol.
+        Each symbol entry is a dict keyed by type.
+        """
+        batch_parms = {"symbols": ",".join([s.upper() for s in symbols]), "types": ",".join(types)}
+        if parms:
+            batch_parms.update(parms)
+        return IEXBase._exec_request("/stock/market/batch", parms=batch_parms)
+
     @staticmethod
     def status_code_message(status_code):
         """
@@ -1,5 +1,5 @@
 #
-# intrinio_cache - cache stores for various Intrinio data
+# iex_cache - cache stores for various IEX data
 # Copyright (C) 2017  Dave Hocker (email: qalydon17@gmail.com)
 #
 # This program is free software: you can redistribute it and/or modify
@@ -15,9 +15,410 @@
 # along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import sys
+import time
+import threading
+import queue
+import json
+import zlib
+from collections import OrderedDict
 from iex_app_logger import AppLogger
+from cache_db import CacheDB
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
 logger = the_app_logger.getAppLogger()
 
+
+class _Flight:
+    """
+    A call in progress. Waiters block on done until the leader has
+    stored the result (or the exception it raised).
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses concurrent calls for the same key into a single call.
+    The first caller for a key runs the function. Callers that arrive
+    while it is running wait for it and share its result.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {key: _Flight}
+        self._flights = {}
+
+    def do(self, key, fn):
+        """
+        Run fn() unless a call for key is already in progress, in which
+        case wait for that call and return its result.
+        :param key: Any hashable value identifying the call.
+        :param fn: Function with no arguments.
+        :return: The value returned by fn(). If fn() raised an exception,
+        the same exception is raised in every caller.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = _Flight()
+                self._flights[key] = flight
+
+        if not leader:
+            logger.debug("Waiting for in-flight request %s", str(key))
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+        except Exception as ex:
+            flight.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+def approx_size(obj):
+    """
+    Approximate the memory used by a decoded JSON value.
+    :param obj: dict, list, str, number, bool or None.
+    :return: Size in bytes.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            size += approx_size(k) + approx_size(v)
+    elif isinstance(obj, (list, tuple)):
+        for v in obj:
+            size += approx_size(v)
+    return size
+
+
+class ResultCache:
+    """
+    Bounded in-memory result cache. Every entry has a time-to-live. When the
+    number of entries or their approximate size exceeds its limit, the least
+    recently used entries are evicted. Expired entries are purged periodically.
+    An entry can be given a grace period during which it is kept after it
+    expires so it can be served stale while it is refreshed.
+    """
+    def __init__(self, max_entries=1000, max_bytes=16 * 1024 * 1024, purge_interval=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Seconds between sweeps for expired entries
+        self.purge_interval = purge_interval
+        # {key: (expiration, retain_until, size, result)} in least to most recently used order
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._next_purge = time.time() + purge_interval
+        self._lock = threading.Lock()
+        # Counters
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """
+        Returns the cached result for a key.
+        :param key:
+        :return: Returns None if there is no unexpired entry for the key.
+        """
+        now = time.time()
+        with self._lock:
+            self._purge_if_due(now)
+            entry = self._lookup(key, now)
+            if entry is None or entry[0] <= now:
+                return None
+            return entry[3]
+
+    def get_entry(self, key):
+        """
+        Returns the cached result for a key, even if it has expired, as long
+        as it is within its grace period.
+        :param key:
+        :return: Tuple (result, fresh) where fresh is False for an expired
+        result. Returns None if there is no usable entry for the key.
+        """
+        now = time.time()
+        with self._lock:
+            self._purge_if_due(now)
+            entry = self._lookup(key, now)
+            if entry is None:
+                return None
+            return entry[3], entry[0] > now
+
+    def put(self, key, result, ttl, grace=0):
+        """
+        Add a result to the cache. An existing entry for the key is replaced.
+        :param key:
+        :param result: The value to be cached.
+        :param ttl: Time-to-live in seconds.
+        :param grace: Seconds an expired entry is kept so it can be served stale.
+        :return: None
+        """
+        size = approx_size(result)
+        now = time.time()
+        with self._lock:
+            self._purge_if_due(now)
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (now + ttl, now + ttl + grace, size, result)
+            self._bytes += size
+            # Evict least recently used entries, but always keep the new one
+            while len(self._entries) > 1 and \
+                    (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                evicted, entry = next(iter(self._entries.items()))
+                self._remove(evicted)
+                self.evictions += 1
+                logger.debug("Evicted %s from result cache", evicted)
+
+    def remove(self, key):
+        """
+        Remove an entry from the cache, if present.
+        :param key:
+        :return: None
+        """
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all entries.
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def purge_expired(self):
+        """
+        Remove every expired entry.
+        :return: The number of entries removed.
+        """
+        with self._lock:
+            return self._purge(time.time())
+
+    def stats(self):
+        """
+        Report the cache's current size and counters.
+        :return: dict
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    # The following methods must be called while holding the lock
+
+    def _lookup(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] <= now:
+            # Past its grace period
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+    def _purge_if_due(self, now):
+        if now >= self._next_purge:
+            self._purge(now)
+
+    def _purge(self, now):
+        expired = [k for k, entry in self._entries.items() if entry[1] <= now]
+        for k in expired:
+            self._remove(k)
+        self.expirations += len(expired)
+        self._next_purge = now + self.purge_interval
+        if expired:
+            logger.debug("Purged %d expired results", len(expired))
+        return len(expired)
+
+
+class TieredCache:
+    """
+    Result cache with two tiers in front of the network. Level 1 is a
+    ResultCache in memory. Level 2 is a table of compressed JSON results in
+    the cache DB, so results survive LibreOffice restarts. A level 2 hit is
+    promoted to level 1 with whatever time-to-live it has left. Every result
+    put in the cache is written to both levels.
+    """
+    def __init__(self, category, l1):
+        """
+        :param category: Result category. Keys the results in level 2.
+        :param l1: ResultCache
+        """
+        self.category = category
+        self.l1 = l1
+        # Counters
+        self.l1_hits = 0
+        self.l2_hits = 0
+        self.network_fetches = 0
+
+    def get(self, key):
+        """
+        Returns the cached result for a key.
+        :param key:
+        :return: Returns None if there is no unexpired result for the key.
+        """
+        entry = self.get_entry(key)
+        if entry and entry[1]:
+            return entry[0]
+        return None
+
+    def get_entry(self, key):
+        """
+        Returns the cached result for a key, even if it has expired, as long
+        as it is within its grace period.
+        :param key:
+        :return: Tuple (result, fresh) or None. See ResultCache.get_entry.
+        """
+        entry = self.l1.get_entry(key)
+        if entry:
+            self.l1_hits += 1
+            return entry
+
+        r = CacheDB.lookup_result_blob(self.category, key)
+        if r is None:
+            return None
+        try:
+            result = json.loads(zlib.decompress(r["Payload"]).decode("utf-8"))
+        except Exception as ex:
+            logger.error("Unreadable cached %s result for %s: %s", self.category, key, str(ex))
+            return None
+        self.l2_hits += 1
+        now = time.time()
+        self.l1.put(key, result, r["Expiration"] - now, grace=r["RetainUntil"] - r["Expiration"])
+        return result, r["Expiration"] > now
+
+    def get_l1(self, key):
+        """
+        Returns the cached result for a key from level 1 only.
+        :param key:
+        :return: Returns None if level 1 has no unexpired result for the key.
+        """
+        return self.l1.get(key)
+
+    def put_l1(self, key, result, ttl):
+        """
+        Add a result to level 1 only (e.g. a view derived from a cached result).
+        :param key:
+        :param result: The value to be cached.
+        :param ttl: Time-to-live in seconds.
+        :return: None
+        """
+        self.l1.put(key, result, ttl)
+
+    def put(self, key, result, ttl, grace=0):
+        """
+        Add a result fetched from the network to both cache levels.
+        :param key:
+        :param result: The value to be cached.
+        :param ttl: Time-to-live in seconds.
+        :param grace: Seconds an expired entry is kept so it can be served stale.
+        :return: None
+        """
+        self.put_many({key: result}, ttl, grace=grace)
+
+    def put_many(self, results, ttl, grace=0):
+        """
+        Add many results fetched from the network to both cache levels. Level 2
+        is written in one transaction.
+        :param results: dict of key: result
+        :param ttl: Time-to-live in seconds.
+        :param grace: Seconds an expired entry is kept so it can be served stale.
+        :return: None
+        """
+        now = time.time()
+        blobs = []
+        for key, result in results.items():
+            self.l1.put(key, result, ttl, grace=grace)
+            payload = zlib.compress(json.dumps(result).encode("utf-8"))
+            blobs.append((key, now + ttl, now + ttl + grace, payload))
+        self.network_fetches += len(blobs)
+        try:
+            CacheDB.insert_result_blobs(self.category, blobs)
+        except Exception as ex:
+            # Level 1 still has the results
+            logger.error("Unable to persist %s results: %s", self.category, str(ex))
+
+    def stats(self):
+        """
+        Report level 1 size and the hits for each tier.
+        :return: dict
+        """
+        stats = self.l1.stats()
+        stats["category"] = self.category
+        stats["l1_hits"] = self.l1_hits
+        stats["l2_hits"] = self.l2_hits
+        stats["network_fetches"] = self.network_fetches
+        return stats
+
+
+class Revalidator:
+    """
+    Background workers that refresh stale cache entries. A key that is
+    already scheduled is not scheduled again until its refresh finishes.
+    """
+    def __init__(self, workers=2):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def schedule(self, key, fn):
+        """
+        Run fn() on a background worker unless key is already scheduled.
+        :param key: Any hashable value identifying the refresh.
+        :param fn: Function with no arguments that refreshes the entry.
+        :return: True if the refresh was scheduled.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+            # Workers are started on first use
+            self._threads = [t for t in self._threads if t.is_alive()]
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._run, name="iex-revalidate")
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        self._queue.put((key, fn))
+        return True
+
+    def _run(self):
+        while True:
+            key, fn = self._queue.get()
+            try:
+                fn()
+            except Exception as ex:
+                logger.error("Refresh of %s failed", str(key))
+                logger.error(str(ex))
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
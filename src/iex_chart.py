@@ -15,11 +15,14 @@
 # along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import time
 from iex_app_logger import AppLogger
+from iex_lib import QConfiguration
 from iex_base import IEXBase
 from cache_db import CacheDB
-from extn_helper import normalize_date
-from datetime import datetime
+from history_store import HistoryStore, to_iso_date
+from extn_helper import normalize_date, normalize_dates
+from datetime import datetime, date, timedelta
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -29,11 +32,48 @@ class IEXChart(IEXBase):
     """
 
     """
+    # Item keys accepted by get_historical_item and the SymbolDate column for each
+    historical_keys = {
+        "open": "Open",
+        "high": "High",
+        "low": "Low",
+        "close": "Close",
+        "volume": "Volume",
+        "adjclose": "Adj_Close"
+    }
+
+    # Minimum number of days in each chart period
+    chart_period_days = {
+        "1m": 28,
+        "3m": 89,
+        "6m": 181,
+        "1y": 365,
+        "2y": 730,
+        "5y": 1826
+    }
+
+    # Number of bars written to the cache DB at a time while a chart streams in
+    ingest_batch_size = 250
+
+    # Unix time of the last chart fetch for each symbol. Dates after a symbol's
+    # coverage are not fetched again until the chart TTL has passed.
+    _fetched_at = {}
+
     def __init__(self):
-        super(IEXChart, self).__init__()
+        super(IEXChart, self).__init__("chart")
         self.time_keys = []
         logger.debug("IEXChart initialized")
 
+    @staticmethod
+    def _is_close_only(r):
+        """
+        Answers the question: Was this SymbolDate record written with only a
+        closing price? Older versions stored zeros for everything but the close.
+        :param r: SymbolDate record
+        :return:
+        """
+        return not (r["Open"] or r["High"] or r["Low"] or r["Volume"])
+
     @staticmethod
     def get_closing_price_for_date(symbol, for_date):
         """
@@ -44,49 +84,272 @@ class IEXChart(IEXBase):
         :param ticker:
         :return:
         """
+        r = IEXChart.get_daily_bar_for_date(symbol, for_date)
+        if isinstance(r, str):
+            return r
+        return r["Close"]
+
+    @staticmethod
+    def get_daily_bar_for_date(symbol, for_date, full_bar=False):
+        """
+        Returns the daily bar (open, high, low, close, volume, adjusted close)
+        for a given symbol on a given date. The bar comes from the cache DB if
+        possible. Otherwise, the IEX chart URL is used to fetch daily chart data
+        and every bar in the chart is cached.
+        :param symbol:
+        :param for_date: ISO format date YYYY-MM-DD
+        :param full_bar: True if more than the closing price is required. A cached
+        record that only has a closing price is then refreshed, unless a chart
+        covering its date has already been fetched (the symbol has only closes).
+        :return: A record with SymbolDate column names as keys or an error message.
+        """
+        symbol = symbol.upper()
+
+        # The history store (if enabled) answers without touching the cache DB
+        if HistoryStore.enabled():
+            r = HistoryStore.lookup_bar(symbol, for_date)
+            if r is None and HistoryStore.lookup_coverage(symbol) is None:
+                # History cached before the store was enabled
+                IEXChart._backfill_history_store(symbol)
+                r = HistoryStore.lookup_bar(symbol, for_date)
+            if r and not (full_bar and IEXChart._is_close_only(r)):
+                logger.debug("History store hit for %s %s", symbol, for_date)
+                return r
 
         # Try for cache hit first
-        r = CacheDB.lookup_closing_price_by_date(symbol.upper(), for_date)
-        if r:
-            price = r["Close"]
-            logger.debug("Closing price cache hit for %s %s %f", symbol.upper(), for_date, price)
-            return price
+        r = CacheDB.lookup_closing_price_by_date(symbol, for_date)
+        if r and not (full_bar and IEXChart._is_close_only(r)):
+            logger.debug("Historical cache hit for %s %s", symbol, for_date)
+            return r
 
-        # Determine the width of the chart data based on the for_date
-        # This can be 1m, 3m, 6m, 1y, 2y or 5y
-        diff = datetime.now() - datetime.strptime(for_date, "%Y-%m-%d")
-        if diff.days <= 30:
-            period = "1m"
-        elif diff.days <= 90:
-            period = "3m"
-        elif diff.days <= 180:
-            period = "6m"
-        elif diff.days <= 365:
-            period = "1y"
-        elif diff.days <= (365 * 2):
-            period = "2y"
-        else:
+        coverage = CacheDB.lookup_coverage(symbol)
+        if coverage and coverage["FirstDate"] <= for_date <= coverage["LastDate"]:
+            if r:
+                # Fetched as a full bar. The symbol only has a closing price.
+                return r
+            # Every trading day in this interval is cached. It must be a market holiday.
+            logger.debug("No trading on %s for %s", for_date, symbol)
+            return "Not found"
+        if coverage and for_date > coverage["LastDate"] and IEXChart._recently_fetched(symbol):
+            # The bar for this date has not been published yet
+            logger.debug("No bar yet for %s on %s", symbol, for_date)
+            return r or "Not found"
+        if for_date < IEXChart._oldest_chart_date():
+            # Older than any chart IEX provides
+            logger.debug("%s on %s is older than the IEX chart history", symbol, for_date)
+            return r or "Not found"
+
+        # The first time a symbol is seen its full 5 year history is loaded
+        # so that later requests for any date in it are answered from the cache DB.
+        if coverage is None:
             period = "5y"
+        else:
+            period = IEXChart._period_for_date(for_date)
+
+        count = IEXChart._fetch_chart(symbol, period)
+        if isinstance(count, str):
+            return count
 
-        url_string = "/stock/{0}/chart/{1}".format(symbol.upper(), period)
-        res = IEXBase._exec_request(url_string, parms=None)
-
-        # There are other more sophisticated ways to search a list.
-        # This one has the advantage of stopping as soon as a match is found.
-        for day in res["result"]:
-            if day["date"] == for_date:
-                # Cache the closing price
-                price = float(day["close"])
-                CacheDB.insert_closing_price(symbol.upper(), for_date, price)
-                logger.debug("Closing price cached for %s %s %f", symbol.upper(), for_date, price)
-                return price
-        logger.error("Chart data for {0} on date {1} was not found".format(symbol.upper(), for_date))
+        refreshed = CacheDB.lookup_closing_price_by_date(symbol, for_date)
+        if refreshed:
+            return refreshed
+        if r:
+            return r
+        logger.error("Chart data for {0} on date {1} was not found".format(symbol, for_date))
         return "Not found"
 
+    @staticmethod
+    def get_closing_prices_for_range(symbol, start_date, end_date):
+        """
+        Returns the closing prices for a symbol over a date range. Only the
+        part of the range that is not already cached is fetched from IEX.
+        :param symbol:
+        :param start_date: ISO format date YYYY-MM-DD
+        :param end_date: ISO format date YYYY-MM-DD
+        :return: List of (date, close) in date order or an error message.
+        """
+        symbol = symbol.upper()
+        # IEX history goes back 5 years. Anything older can't be fetched.
+        eff_start = max(start_date, IEXChart._oldest_chart_date())
+
+        # Find the oldest date that is not covered by the cache DB
+        coverage = CacheDB.lookup_coverage(symbol)
+        missing_from = None
+        if coverage is None or eff_start < coverage["FirstDate"]:
+            missing_from = eff_start
+        elif end_date > coverage["LastDate"] and not IEXChart._recently_fetched(symbol):
+            missing_from = coverage["LastDate"]
+
+        if missing_from and missing_from <= end_date:
+            logger.debug("Historical range for %s missing from %s", symbol, missing_from)
+            count = IEXChart._fetch_chart(symbol, IEXChart._period_for_date(missing_from))
+            if isinstance(count, str):
+                return count
+
+        series = IEXChart._series_from_history_store(symbol, start_date, end_date)
+        if series is not None:
+            return series
+        return [(r["Date"], r["Close"]) for r in CacheDB.lookup_closing_prices_in_range(symbol, start_date, end_date)]
+
+    @staticmethod
+    def _series_from_history_store(symbol, start_date, end_date):
+        """
+        Returns the closing prices for a date range from the history store,
+        provided the store holds everything the cache DB covers in that range.
+        :return: List of (date, close) in date order or None
+        """
+        if not HistoryStore.enabled():
+            return None
+        coverage = CacheDB.lookup_coverage(symbol)
+        stored = HistoryStore.lookup_coverage(symbol)
+        if coverage is None or stored is None:
+            return None
+        # The store must cover whatever part of the range the cache DB covers
+        first = max(start_date, coverage["FirstDate"])
+        last = min(end_date, coverage["LastDate"])
+        if first <= last and (stored[0] > first or stored[1] < last):
+            return None
+        dates, bars = HistoryStore.lookup_range(symbol, start_date, end_date)
+        return list(zip(map(to_iso_date, dates.tolist()), bars[3].tolist()))
+
+    @staticmethod
+    def _backfill_history_store(symbol):
+        """
+        Copy the daily bars of a symbol from the cache DB into the history store.
+        :param symbol: Upper case ticker symbol.
+        :return: None
+        """
+        writer = HistoryStore.writer(symbol)
+        bars = CacheDB.lookup_daily_bars(symbol)
+        if writer and bars:
+            writer.add([tuple(r)[1:] for r in bars])
+            # Without coverage in the cache DB only the dates of the bars themselves are known
+            coverage = CacheDB.lookup_coverage(symbol)
+            if coverage:
+                writer.commit(coverage["FirstDate"], coverage["LastDate"])
+            else:
+                writer.commit(bars[0]["Date"], bars[-1]["Date"])
+
+    @staticmethod
+    def _oldest_chart_date():
+        """
+        Returns the oldest date a 5 year chart is sure to contain.
+        :return: ISO format date YYYY-MM-DD
+        """
+        return (date.today() - timedelta(days=IEXChart.chart_period_days["5y"])).isoformat()
+
+    @staticmethod
+    def _recently_fetched(symbol):
+        """
+        Answers the question: Was a chart for this symbol fetched within the chart TTL?
+        :param symbol: Upper case ticker symbol.
+        :return:
+        """
+        fetched_at = IEXChart._fetched_at.get(symbol)
+        return fetched_at is not None and time.time() - fetched_at < QConfiguration.get_cache_ttl("chart")
+
+    @staticmethod
+    def _period_for_date(for_date):
+        """
+        Returns the smallest chart period that contains a date.
+        :param for_date: ISO format date YYYY-MM-DD
+        :return: 1m, 3m, 6m, 1y, 2y or 5y
+        """
+        diff = datetime.now() - datetime.strptime(for_date, "%Y-%m-%d")
+        for period in ["1m", "3m", "6m", "1y", "2y"]:
+            if diff.days <= IEXChart.chart_period_days[period]:
+                return period
+        return "5y"
+
+    @staticmethod
+    def _fetch_chart(symbol, period):
+        """
+        Fetch a daily chart from IEX and cache every bar in it. The interval
+        that the chart covers is merged into the symbol's cache coverage.
+        :param symbol: Upper case ticker symbol.
+        :param period: 1m, 3m, 6m, 1y, 2y or 5y
+        :return: Number of bars cached or an error message.
+        """
+        # Concurrent misses for the same symbol and period share one chart download
+        return IEXBase.single_flight.do(("chart", "{0}-{1}".format(symbol, period)),
+                                        lambda: IEXChart._ingest_chart(symbol, period))
+
+    @staticmethod
+    def _ingest_chart(symbol, period):
+        """
+        Stream a daily chart from IEX into the cache DB. Bars are parsed one
+        at a time as the chart arrives and written in batches, so memory use
+        does not depend on the period.
+        :param symbol: Upper case ticker symbol.
+        :param period: 1m, 3m, 6m, 1y, 2y or 5y
+        :return: Number of bars cached or an error message.
+        """
+        batch = []
+        cached = [0]
+        # Dates of the oldest and newest bars received
+        received = [None, None]
+        history = HistoryStore.writer(symbol)
+
+        def write_batch():
+            CacheDB.insert_daily_bars(symbol, batch)
+            if history:
+                history.add(batch)
+            cached[0] += len(batch)
+            del batch[:]
+
+        def handle_day(day):
+            # IEX chart prices are split adjusted, so close is also the adjusted close.
+            if day.get("close") is not None:
+                close = float(day["close"])
+                if received[0] is None or day["date"] < received[0]:
+                    received[0] = day["date"]
+                if received[1] is None or day["date"] > received[1]:
+                    received[1] = day["date"]
+                batch.append((day["date"], float(day.get("open") or 0), float(day.get("high") or 0),
+                              float(day.get("low") or 0), close, int(day.get("volume") or 0), close))
+                if len(batch) >= IEXChart.ingest_batch_size:
+                    write_batch()
+
+        url_string = "/stock/{0}/chart/{1}".format(symbol, period)
+        res = IEXBase._exec_request_stream(url_string, handle_day)
+        if res["status_code"] != 200:
+            return res.get("error_message", IEXBase.status_code_message(res["status_code"]))
+        if "bad_payload" in res:
+            # Bars that were cached are valid, but the coverage can't be extended
+            return "Invalid chart data"
+        if batch:
+            write_batch()
+        logger.debug("%d daily bars cached for %s", cached[0], symbol)
+        IEXChart._fetched_at[symbol] = time.time()
+        if received[1] is None:
+            return 0
+
+        # Every trading day from the start of the period through the last bar
+        # is now cached. A day's bar is published after the day ends, so the
+        # coverage never extends past yesterday.
+        today = date.today()
+        first_date = (today - timedelta(days=IEXChart.chart_period_days[period])).isoformat()
+        first_date = min(first_date, received[0])
+        last_date = min(received[1], (today - timedelta(days=1)).isoformat())
+        if last_date < first_date:
+            return cached[0]
+        if history:
+            history.commit(first_date, last_date)
+        coverage = CacheDB.lookup_coverage(symbol)
+        if coverage and coverage["LastDate"] >= first_date:
+            first_date = min(first_date, coverage["FirstDate"])
+        CacheDB.update_coverage(symbol, first_date, last_date)
+
+        return cached[0]
+
 # Singleton instance of the IEXChart class
 # chart_inst = IEXChart()
 
 def get_closing_price(symbol, for_date):
+    if isinstance(for_date, (tuple, list)):
+        # A range of dates (array formula)
+        return _for_each_date(for_date, lambda d: IEXChart.get_closing_price_for_date(symbol, d))
+
     # Resolve date. It can be a LibreCalc date as a float or a string date
     try:
         eff_date = normalize_date(for_date)
@@ -95,3 +358,90 @@ def get_closing_price(symbol, for_date):
         return "Invalid date format"
 
     return IEXChart.get_closing_price_for_date(symbol, eff_date)
+
+
+def get_historical_item(symbol, for_date, key):
+    """
+    Returns an item from the daily bar for a symbol on a given date.
+    :param symbol: Target stock ticker symbol.
+    :param for_date: LibreCalc date as a float or a string date, or a range of dates.
+    :param key: open, high, low, close, volume or adjclose.
+    :return: Item value or error message. For a range of dates, a tuple of row tuples.
+    """
+    column = IEXChart.historical_keys.get(key.lower())
+    if not column:
+        return "Invalid historical key"
+
+    if isinstance(for_date, (tuple, list)):
+        # A range of dates (array formula)
+        return _for_each_date(for_date, lambda d: _historical_item(symbol, d, column))
+
+    try:
+        eff_date = normalize_date(for_date)
+    except ValueError as ex:
+        logger.error(str(ex))
+        return "Invalid date format"
+    return _historical_item(symbol, eff_date, column)
+
+
+def _historical_item(symbol, eff_date, column):
+    """
+    Returns a SymbolDate column from the daily bar for a symbol on a date.
+    :param eff_date: ISO format date YYYY-MM-DD
+    :return: Item value or error message
+    """
+    r = IEXChart.get_daily_bar_for_date(symbol, eff_date, full_bar=(column != "Close"))
+    if isinstance(r, str):
+        return r
+    if column == "Adj_Close" and not r["Adj_Close"]:
+        # Records with only a closing price have no adjusted close
+        return r["Close"]
+    if column != "Close" and IEXChart._is_close_only(r):
+        return "NA"
+    return r[column]
+
+
+def get_historical_series(symbol, start_date, end_date):
+    """
+    Returns the closing prices for a symbol over a date range.
+    :param symbol: Target stock ticker symbol.
+    :param start_date: LibreCalc date as a float or a string date.
+    :param end_date: LibreCalc date as a float or a string date. If empty, today.
+    :return: Tuple of (date, close) rows
+    """
+    eff_start, eff_end = normalize_dates(((start_date, end_date),), invalid=ValueError)[0]
+    if eff_start is ValueError or eff_end is ValueError:
+        logger.error("Invalid date range %s %s", start_date, end_date)
+        return (("Invalid date format", ""),)
+    if not eff_start:
+        return (("Invalid date format", ""),)
+    if not eff_end:
+        eff_end = date.today().isoformat()
+
+    rows = IEXChart.get_closing_prices_for_range(symbol, eff_start, eff_end)
+    if isinstance(rows, str):
+        return ((rows, ""),)
+    if not rows:
+        return (("Not found", ""),)
+    return tuple(rows)
+
+
+def _for_each_date(cell_range, get_value):
+    """
+    Apply a function to every date in a cell range.
+    :param cell_range: Range of LibreCalc dates (tuple of row tuples).
+    :param get_value: Function of an ISO format date returning a value or error message.
+    :return: Tuple of row tuples with the shape of the range. Empty cells stay empty.
+    """
+    rows = []
+    for row in normalize_dates(cell_range, invalid=ValueError):
+        values = []
+        for eff_date in row:
+            if eff_date is ValueError:
+                values.append("Invalid date format")
+            elif not eff_date:
+                values.append("")
+            else:
+                values.append(get_value(eff_date))
+        rows.append(tuple(values))
+    return tuple(rows)
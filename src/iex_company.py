@@ -18,6 +18,7 @@
 from iex_app_logger import AppLogger
 from iex_stocks import IEXStocks
 from iex_base import IEXBase
+from extn_helper import flatten_range
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -28,8 +29,9 @@ class IEXCompany(IEXBase):
 
     """
     def __init__(self):
-        super(IEXCompany, self).__init__()
+        super(IEXCompany, self).__init__("company")
         self.time_keys = []
+        self.batch_type = "company"
         logger.debug("IEXCompany initialized")
 
     # The dervived class must override this method
@@ -42,16 +44,7 @@ class IEXCompany(IEXBase):
         :return:
         """
         symbol = symbol.upper()
-        res = self._get_cached_result(symbol)
-        if res:
-            logger.debug("Company cache hit for %s", symbol)
-        else:
-            logger.debug("Company cache miss for %s", symbol)
-            res = IEXStocks.get_company(symbol)
-            if res["status_code"] == 200:
-                self._cache_result(symbol, res)
-                logger.debug("Company cached for %s", symbol)
-        return res
+        return self._get_cached_or_fetch(symbol, lambda: IEXStocks.get_company(symbol))
 
 # Singleton instance of the IEXQuote class
 company_inst = IEXCompany()
@@ -80,3 +73,12 @@ def get_company_item(symbol, key):
     """
     # This is a temporary solution for items that are Unix timestamps.
     return company_inst.get_result_item("company", symbol, key)
+
+def get_company_table(symbols, keys):
+    """
+    Returns a table of company items with a row for each symbol and a column for each key.
+    :param symbols: Range of stock ticker symbols.
+    :param keys: Range of item keys.
+    :return: Tuple of row tuples
+    """
+    return company_inst.get_result_table("company", flatten_range(symbols), flatten_range(keys))
@@ -16,9 +16,15 @@
 #
 
 import datetime
+import calendar
+import time
+import threading
+from collections import OrderedDict
+from datetime import date, timedelta
 from iex_app_logger import AppLogger
 from iex_stocks import IEXStocks
 from iex_base import IEXBase
+from iex_lib import QConfiguration
 from cache_db import CacheDB
 from extn_helper import normalize_date
 
@@ -33,59 +39,133 @@ class IEXDividends(IEXBase):
     dividend period and dividend period range that is used in the
     IEX API.
     """
+    # Minimum number of days covered by each period range
+    range_days = {
+        "1m": 28,
+        "3m": 89,
+        "6m": 181,
+        "1y": 365,
+        "2y": 730,
+        "5y": 1826
+    }
+
+    # Unix time each symbol's dividend history was last refreshed
+    _refreshed_at = {}
+
+    # Period ranges from widest to narrowest (ytd falls between 1y and 1m)
+    period_ranges = ["5y", "2y", "1y", "ytd", "6m", "3m", "1m"]
+    # Symbols whose widest period range is remembered
+    max_widest_ranges = 4096
+
     def __init__(self):
-        super(IEXDividends, self).__init__()
+        super(IEXDividends, self).__init__("dividends")
         self.time_keys = []
-        self.default_range = "1y"
+        # The widest period range fetched for each symbol in least recently
+        # used order. Narrower ranges are answered by filtering its result.
+        self._widest_range = OrderedDict()
+        self._widest_lock = threading.Lock()
         logger.debug("IEXDividends initialized")
 
     # The dervived class must override this method
     def _get_result_for_symbol(self, symbol, period_range):
         """
-        Returns a result for a given stock ticker symbol. This method
-        MUST be overriden by the derived class so it gets the result
-        specific to the derived class.
+        Returns a result for a given stock ticker symbol. Only the widest
+        period range requested for a symbol is fetched and cached. A narrower
+        period range is the dividends in it with an ex-date in the narrower range.
         :param symbol: The target stock ticker symbol.
+        :param period_range: 5y, 2y, 1y, ytd, 6m, 3m or 1m
         :return:
         """
         symbol = symbol.upper()
-        cache_key = "{0}-{1}".format(symbol, period_range)
-        res = self._get_cached_result(cache_key)
-        if res:
-            logger.debug("Dividends cache hit for %s", cache_key)
-        else:
-            logger.debug("Dividends cache miss for %s", cache_key)
-            res = IEXStocks.get_dividends(symbol, period_range)
-            if res["status_code"] == 200:
-                self._cache_result(cache_key, res)
-                logger.debug("Dividends cached for %s", cache_key)
+        if period_range not in self.period_ranges:
+            # Let IEX judge the period range
+            return self._get_cached_or_fetch("{0}-{1}".format(symbol, period_range),
+                                             lambda: IEXDividends._fetch_dividends(symbol, period_range))
+
+        today = date.today()
+        first_date = IEXDividends._range_first_date(period_range, today)
+        with self._widest_lock:
+            widest = self._widest_range.get(symbol)
+            if widest is not None:
+                self._widest_range.move_to_end(symbol)
+        if widest is None or IEXDividends._range_first_date(widest, today) > first_date:
+            widest = self._find_cached_range(symbol, period_range, today)
+            with self._widest_lock:
+                self._widest_range[symbol] = widest
+                while len(self._widest_range) > self.max_widest_ranges:
+                    self._widest_range.popitem(last=False)
+
+        cache_key = "{0}-{1}".format(symbol, widest)
+        res = self._get_cached_or_fetch(cache_key, lambda: IEXDividends._fetch_dividends(symbol, widest))
+        if widest == period_range or res["status_code"] != 200:
+            return res
+
+        # Filtered views are kept in memory with the results, under the same limits.
+        # A view is current if it was made from the result fetched at the same time.
+        view_key = "{0}-{1}-of-{2}".format(symbol, period_range, widest)
+        fetched = res.get("fetched")
+        view = self.result_cache.get_l1(view_key)
+        if view is None or view["fetched"] != fetched:
+            first_date = first_date.isoformat()
+            view = {"status_code": 200, "fetched": fetched,
+                    "result": [d for d in res["result"] if (d.get("exDate") or "") >= first_date]}
+            if fetched:
+                self.result_cache.put_l1(view_key, view, QConfiguration.get_cache_ttl(self.category))
+        return view
+
+    @staticmethod
+    def _fetch_dividends(symbol, period_range):
+        """
+        Call IEX for the dividends of a symbol. A successful result is
+        stamped with the time it was fetched (Unix time).
+        :return: The result dict
+        """
+        res = IEXStocks.get_dividends(symbol, period_range)
+        if res["status_code"] == 200:
+            res["fetched"] = time.time()
         return res
 
-    def _get_result_keys(self):
+    def _find_cached_range(self, symbol, period_range, today):
         """
-        Return the list of keys in a result. The keys are taken from
-        the first period in a divdend result.
-        :return:
+        Returns the widest period range containing period_range for which
+        a result is cached (possibly from an earlier session).
+        :return: The cached period range or period_range if none is cached.
         """
-        if not self.result_keys:
-            res = self._get_result_for_symbol(self.template_symbol, self.default_range)
-            if res["status_code"] != 200:
-                return None
-            # Sort keys case insensitive. Avoids randomized list of keys.
-            self.result_keys = list(res["result"][0].keys())
-            self.result_keys.sort(key=lambda k: k.lower())
-        return self.result_keys
+        first_date = IEXDividends._range_first_date(period_range, today)
+        for r in self.period_ranges:
+            if r == period_range:
+                break
+            if IEXDividends._range_first_date(r, today) <= first_date and \
+                    self.result_cache.get_entry("{0}-{1}".format(symbol, r)):
+                return r
+        return period_range
+
+    @staticmethod
+    def _range_first_date(period_range, today):
+        """
+        Returns the first date of a period range ending today.
+        :param period_range: 5y, 2y, 1y, ytd, 6m, 3m or 1m
+        :param today: date
+        :return: date
+        """
+        if period_range == "ytd":
+            return date(today.year, 1, 1)
+        months = int(period_range[:-1])
+        if period_range.endswith("y"):
+            months *= 12
+        year, month = divmod(today.year * 12 + today.month - 1 - months, 12)
+        month += 1
+        return date(year, month, min(today.day, calendar.monthrange(year, month)[1]))
 
-    def get_result_key_count(self):
+    def _extract_result_keys(self, result):
         """
-        Returns the number of keys in a result. The keys are taken from
+        Returns the keys in a result. The keys are taken from
         the first period in a divdend result.
         :return:
         """
-        res = self._get_result_for_symbol(self.template_symbol, self.default_range)
-        if res["status_code"] == 200:
-            return len(res["result"][0])
-        return res["error_message"]
+        if result:
+            return result[0].keys()
+        return None
 
     def get_result_result_period_count(self, symbol, period_range):
         """
@@ -112,7 +192,7 @@ class IEXDividends(IEXBase):
                 # This is here for comprehensive coverage.
                 # Currently, none of the result values required conversion.
                 # Apply time conversion as required
-                v = res["result"][period][key]
+                v = res["result"][period].get(key)
                 if key in self.time_keys:
                     if v:
                         # Convert IEX timestamp value to something human readable
@@ -126,6 +206,119 @@ class IEXDividends(IEXBase):
             return res["error_message"]
         return "Invalid {0} key".format(category)
 
+    def get_ttm(self, symbol, asofdate):
+        """
+        Returns the trailing twelve months dividends of a symbol as of a date.
+        The sum is taken over the DividendHistory table. IEX is only called the
+        first time a symbol is seen, when asofdate is after its history (at most
+        once per dividends TTL) and when an older history is available.
+        :param symbol: Stock ticker symbol
+        :param asofdate: ISO format date YYYY-MM-DD
+        :return: Trailing twelve months dividends or error message
+        """
+        symbol = symbol.upper()
+        window_start = IEXDividends._year_before(asofdate)
+        oldest = (date.today() - timedelta(days=IEXDividends.range_days["5y"])).isoformat()
+
+        coverage = CacheDB.lookup_dividend_coverage(symbol)
+        period_range = None
+        if coverage is None:
+            # The first time a symbol is seen its full 5 year history is loaded
+            # so that any as-of date in it is answered from the cache DB.
+            period_range = "5y"
+        elif window_start < coverage["FirstDate"] and oldest < coverage["FirstDate"]:
+            # IEX has older dividends than the cache DB
+            period_range = IEXDividends._range_for_date(window_start)
+        elif asofdate > coverage["LastDate"] and not IEXDividends._recently_refreshed(symbol):
+            # Only dividends since the last refresh are fetched
+            period_range = IEXDividends._range_for_date(coverage["LastDate"])
+
+        if period_range:
+            res = self._get_result_for_symbol(symbol, period_range)
+            if res["status_code"] != 200:
+                return res["error_message"]
+            IEXDividends._store_history(symbol, period_range, res)
+            coverage = CacheDB.lookup_dividend_coverage(symbol)
+
+        if coverage is None or window_start < coverage["FirstDate"]:
+            # Part of the twelve months is older than any available history
+            logger.debug("TTM Dividends for %s %s are not available", symbol, asofdate)
+            return "Not found"
+
+        ttm = CacheDB.sum_dividends_in_range(symbol, window_start, asofdate)
+        logger.debug("TTM Dividends for %s %s: %f", symbol, asofdate, ttm)
+        return ttm
+
+    @staticmethod
+    def _store_history(symbol, period_range, res):
+        """
+        Insert the dividends of a result into DividendHistory and merge the
+        interval the period range covered when it was fetched into the
+        symbol's dividend coverage.
+        :param symbol: Upper case ticker symbol
+        :param period_range: 1m, 3m, 6m, 1y, 2y or 5y
+        :param res: Dividends result
+        :return: None
+        """
+        rows = []
+        for d in res["result"]:
+            try:
+                rows.append((d["exDate"][0:10], float(d["amount"]),
+                             d.get("paymentDate"), d.get("recordDate"), d.get("declaredDate")))
+            except (KeyError, TypeError, ValueError):
+                logger.debug("Dividend for %s skipped: %s", symbol, str(d))
+        CacheDB.insert_dividends(symbol, rows)
+
+        # A result cached before fetch times were recorded is as old as the TTL allows
+        fetched = res.get("fetched") or time.time() - QConfiguration.get_cache_ttl("dividends")
+        IEXDividends._refreshed_at[symbol] = time.time()
+        fetch_date = date.fromtimestamp(fetched)
+        first_date = (fetch_date - timedelta(days=IEXDividends.range_days[period_range])).isoformat()
+        last_date = fetch_date.isoformat()
+        coverage = CacheDB.lookup_dividend_coverage(symbol)
+        if coverage and coverage["LastDate"] >= first_date:
+            first_date = min(first_date, coverage["FirstDate"])
+            last_date = max(last_date, coverage["LastDate"])
+        CacheDB.update_dividend_coverage(symbol, first_date, last_date)
+        logger.debug("%d dividends cached for %s", len(rows), symbol)
+
+    @staticmethod
+    def _recently_refreshed(symbol):
+        """
+        Answers the question: Was the dividend history of this symbol
+        refreshed within the dividends TTL?
+        :param symbol: Upper case ticker symbol
+        :return:
+        """
+        refreshed_at = IEXDividends._refreshed_at.get(symbol)
+        return refreshed_at is not None and \
+            time.time() - refreshed_at < QConfiguration.get_cache_ttl("dividends")
+
+    @staticmethod
+    def _range_for_date(for_date):
+        """
+        Returns the smallest period range that contains a date.
+        :param for_date: ISO format date YYYY-MM-DD
+        :return: 1m, 3m, 6m, 1y, 2y or 5y
+        """
+        diff = datetime.datetime.now() - datetime.datetime.strptime(for_date, "%Y-%m-%d")
+        for period_range in ["1m", "3m", "6m", "1y", "2y"]:
+            if diff.days <= IEXDividends.range_days[period_range]:
+                return period_range
+        return "5y"
+
+    @staticmethod
+    def _year_before(for_date):
+        """
+        Returns the same date one year earlier (Feb 29 becomes Feb 28).
+        :param for_date: ISO format date YYYY-MM-DD
+        :return: ISO format date YYYY-MM-DD
+        """
+        d = datetime.datetime.strptime(for_date, "%Y-%m-%d").date()
+        if d.month == 2 and d.day == 29:
+            d = d.replace(day=28)
+        return d.replace(year=d.year - 1).isoformat()
+
 # Singleton instance of the IEXDividends class
 dividends_inst = IEXDividends()
 
@@ -171,30 +364,13 @@ def get_dividends_ttm(symbol, asofdate):
     """
     Returns the trailing twelve months dividends for a given ticker symbol.
     :param symbol: Stock ticker symbol
+    :param asofdate: The last day of the twelve months. The current date if omitted.
     :return: Trailing twelve months dividends
     """
     # If no date is given, use the current date
+    if asofdate:
+        asofdate = normalize_date(asofdate)
     if not asofdate:
         asofdate = datetime.datetime.now().strftime("%Y-%m-%d")
-    else:
-        asofdate = normalize_date(asofdate)
 
-    symbol = symbol.upper()
-
-    # Check cache first
-    r = CacheDB.lookup_ttm_dividend_by_date(symbol, asofdate)
-    if r:
-        logger.debug("TTM Dividends cache hit for %s %s", symbol, asofdate)
-        ttm = r["Amount"]
-    else:
-        # No cache record, do the calculation
-        logger.debug("TTM Dividends cache miss for %s %s", symbol, asofdate)
-        ttm = 0.0
-        num_periods = get_dividends_period_count(symbol, "1y")
-        logger.debug("Number of periods in TTM: %d", num_periods)
-        for i in range(num_periods):
-            ttm += dividends_inst.get_result_item("dividends", symbol, "amount", i, "1y")
-        # Persistently cache this TTM dividend
-        CacheDB.insert_ttm_dividend(symbol, asofdate, ttm)
-        logger.debug("TTM Dividends cached for %s %s", symbol, asofdate)
-    return ttm
\ No newline at end of file
+    return dividends_inst.get_ttm(symbol, asofdate)
@@ -30,7 +30,7 @@ class IEXEarnings(IEXBase):
     earnings period used in the IEX API.
     """
     def __init__(self):
-        super(IEXEarnings, self).__init__()
+        super(IEXEarnings, self).__init__("earnings")
         self.time_keys = []
         logger.debug("IEXEarnings initialized")
 
@@ -44,43 +44,17 @@ class IEXEarnings(IEXBase):
         :return:
         """
         symbol = symbol.upper()
-        cache_key = symbol
-        res = self._get_cached_result(cache_key)
-        if res:
-            logger.debug("Earnings cache hit for %s", cache_key)
-        else:
-            logger.debug("Earnings cache miss for %s", cache_key)
-            res = IEXStocks.get_earnings(symbol)
-            if res["status_code"] == 200:
-                self._cache_result(cache_key, res)
-                logger.debug("Earnings cached for %s", cache_key)
-        return res
-
-    def _get_result_keys(self):
-        """
-        Return the list of keys in a result. The keys are taken from
-        the first period in a divdend result.
-        :return:
-        """
-        if not self.result_keys:
-            res = self._get_result_for_symbol(self.template_symbol)
-            if res["status_code"] != 200:
-                return None
-            # Sort keys case insensitive. Avoids randomized list of keys.
-            self.result_keys = list(res["result"]["earnings"][0].keys())
-            self.result_keys.sort(key=lambda k: k.lower())
-        return self.result_keys
+        return self._get_cached_or_fetch(symbol, lambda: IEXStocks.get_earnings(symbol))
 
-    def get_result_key_count(self):
+    def _extract_result_keys(self, result):
         """
-        Returns the number of keys in a result. The keys are taken from
-        the first period in a divdend result.
+        Returns the keys in a result. The keys are taken from
+        the first period in an earnings result.
         :return:
         """
-        res = self._get_result_for_symbol(self.template_symbol)
-        if res["status_code"] == 200:
-            return len(res["result"]["earnings"][0])
-        return res["error_message"]
+        if result and result.get("earnings"):
+            return result["earnings"][0].keys()
+        return None
 
     def get_result_item(self, category, symbol, key, period):
         """
@@ -98,7 +72,7 @@ class IEXEarnings(IEXBase):
                 # This is here for comprehensive coverage.
                 # Currently, none of the result values required conversion.
                 # Apply time conversion as required
-                v = res["result"]["earnings"][period][key]
+                v = res["result"]["earnings"][period].get(key)
                 if key in self.time_keys:
                     if v:
                         # Convert IEX timestamp value to something human readable
@@ -21,9 +21,14 @@
 #
 
 try:
+    import time
+    # Start of the import-time measurement
+    load_start = time.time()
     import os
     import sys
+    import re
     import inspect
+    import importlib
     import threading
     import unohelper
     from com.iex.api.localc import XIex
@@ -37,25 +42,22 @@ try:
 
     # Local imports go here
     from iex_app_logger import AppLogger
-    import xml.etree.ElementTree as etree
+    from iex_metrics import metrics
 
     # Logger init
     the_app_logger = AppLogger("iex-extension")
     logger = the_app_logger.getAppLogger()
-    # Extract version from description.xml
-    tree = etree.parse(cmd_folder + "/description.xml")
-    root = tree.getroot()
-    nodes = root.findall('{http://openoffice.org/extensions/description/2006}version')
-    logger.info("IEX-LOCalc Version: %s", nodes[0].attrib["value"])
-    # After logger
-    from iex_price import get_price
-    from iex_quote import get_quote_key_count, get_quote_keyx, get_quote_item
-    from iex_company import get_company_key_count, get_company_keyx, get_company_item
-    from iex_keystats import get_keystats_key_count, get_keystats_keyx, get_keystats_item
-    from iex_dividends import get_dividends_key_count, get_dividends_period_count, get_dividends_keyx, \
-        get_dividends_item, get_dividends_ttm
-    from iex_earnings import get_earnings_key_count, get_earnings_keyx, get_earnings_item
-    from iex_chart import get_closing_price
+
+    # Everything else (configuration, category modules, SSL and the cache DB)
+    # is initialized on first use so LO Calc does not stall while the add-in
+    # registers. Importing this module should take no longer than this (seconds).
+    import_time_budget = 0.1
+    load_time = time.time() - load_start
+    if load_time > import_time_budget:
+        logger.warning("IEX extension import took %.1f ms (budget %.1f ms)", load_time * 1000,
+                       import_time_budget * 1000)
+    else:
+        logger.debug("IEX extension import took %.1f ms", load_time * 1000)
 except Exception as ex:
     # Emergency debugging to cover for the fact that LibreOffice is terrible at debugging...
     from iex_lib import QConfiguration
@@ -64,89 +66,179 @@ except Exception as ex:
     fh.close()
     exit(666)
 
+def _module(name):
+    """
+    Returns a local module, importing it on first use. import_module is
+    used even when the module is in sys.modules. If another thread (e.g.
+    _deferred_start) is still importing it, this waits for the import to finish.
+    :param name: Module name (e.g. iex_quote)
+    :return: The module
+    """
+    return importlib.import_module(name)
+
+# Set once the deferred start up work has been done
+_started = False
+_start_lock = threading.Lock()
+
+def _deferred_start():
+    """
+    Start up work that does not need to happen while the add-in registers.
+    It runs on a background thread when the first IexImpl is created.
+    :return: None
+    """
+    try:
+        # Extract version from description.xml
+        fh = open(os.path.join(cmd_folder, "description.xml"), "r")
+        m = re.search(r'<(?:\w+:)?version\s+value="([^"]+)"', fh.read())
+        fh.close()
+        logger.info("IEX-LOCalc Version: %s", m.group(1) if m else "unknown")
+        # Warm caches for the watchlist (if any) while LO Calc finishes loading
+        _module("iex_prefetch").start_watchlist_prefetch()
+        # Periodically write the metrics next to the log file
+        QConfiguration = _module("iex_lib").QConfiguration
+        _module("iex_metrics").start_metrics_dump(QConfiguration.home_data_path() + "iex-metrics.json",
+                                                  QConfiguration.metrics_interval)
+    except Exception as ex:
+        logger.error("Deferred start up failed: %s", str(ex))
+
 class IexImpl(unohelper.Base, XIex ):
     """Define the main class for the IEX LO Calc extension """
     def __init__( self, ctx ):
+        global _started
         self.ctx = ctx
+        with _start_lock:
+            if not _started:
+                _started = True
+                t = threading.Thread(target=_deferred_start, name="iex-start")
+                t.daemon = True
+                t.start()
         logger.debug("IexImpl initialized")
         logger.debug("self: %s", str(self))
         logger.debug("ctx: %s", str(ctx))
 
+    @metrics.timed("impl.IexPrice")
     def IexPrice(self, symbol):
         logger.debug("IexPrice called %s", symbol)
-        return get_price(symbol)
+        return _module("iex_price").get_price(symbol)
 
+    @metrics.timed("impl.IexQuoteKeyCount")
     def IexQuoteKeyCount(self):
         logger.debug("IexQuoteKeyCount called")
-        return get_quote_key_count()
+        return _module("iex_quote").get_quote_key_count()
 
+    @metrics.timed("impl.IexQuoteKeyByIndex")
     def IexQuoteKeyByIndex(self, index):
         logger.debug("IexQuoteKeyByIndex called %d", index)
-        return get_quote_keyx(index)
+        return _module("iex_quote").get_quote_keyx(index)
 
+    @metrics.timed("impl.IexQuoteItem")
     def IexQuoteItem(self, symbol, key):
         logger.debug("IexQuoteItem called %s %s", symbol, key)
-        return get_quote_item(symbol, key)
+        return _module("iex_quote").get_quote_item(symbol, key)
+
+    @metrics.timed("impl.IexQuoteTable")
+    def IexQuoteTable(self, symbols, keys):
+        logger.debug("IexQuoteTable called %s %s", symbols, keys)
+        return _module("iex_quote").get_quote_table(symbols, keys)
 
+    @metrics.timed("impl.IexCompanyKeyCount")
     def IexCompanyKeyCount(self):
         logger.debug("IexCompanyKeyCount called")
-        return get_company_key_count()
+        return _module("iex_company").get_company_key_count()
 
+    @metrics.timed("impl.IexCompanyKeyByIndex")
     def IexCompanyKeyByIndex(self, index):
         logger.debug("IexCompanyKeyByIndex called %d", index)
-        return get_company_keyx(index)
+        return _module("iex_company").get_company_keyx(index)
 
+    @metrics.timed("impl.IexCompanyItem")
     def IexCompanyItem(self, symbol, key):
         logger.debug("IexCompanyItem called %s %s", symbol, key)
-        return get_company_item(symbol, key)
+        return _module("iex_company").get_company_item(symbol, key)
 
+    @metrics.timed("impl.IexCompanyTable")
+    def IexCompanyTable(self, symbols, keys):
+        logger.debug("IexCompanyTable called %s %s", symbols, keys)
+        return _module("iex_company").get_company_table(symbols, keys)
+
+    @metrics.timed("impl.IexKeyStatsKeyCount")
     def IexKeyStatsKeyCount(self):
         logger.debug("IexKeyStatsKeyCount called")
-        return get_keystats_key_count()
+        return _module("iex_keystats").get_keystats_key_count()
 
+    @metrics.timed("impl.IexKeyStatsKeyByIndex")
     def IexKeyStatsKeyByIndex(self, index):
         logger.debug("IexKeyStatsKeyByIndex called %d", index)
-        return get_keystats_keyx(index)
+        return _module("iex_keystats").get_keystats_keyx(index)
 
+    @metrics.timed("impl.IexKeyStatsItem")
     def IexKeyStatsItem(self, symbol, key):
         logger.debug("IexKeyStatsItem called %s %s", symbol, key)
-        return get_keystats_item(symbol, key)
+        return _module("iex_keystats").get_keystats_item(symbol, key)
+
+    @metrics.timed("impl.IexKeyStatsTable")
+    def IexKeyStatsTable(self, symbols, keys):
+        logger.debug("IexKeyStatsTable called %s %s", symbols, keys)
+        return _module("iex_keystats").get_keystats_table(symbols, keys)
 
+    @metrics.timed("impl.IexDividendsKeyCount")
     def IexDividendsKeyCount(self):
         logger.debug("IexDividendsKeyCount called")
-        return get_dividends_key_count()
+        return _module("iex_dividends").get_dividends_key_count()
 
+    @metrics.timed("impl.IexDividendsPeriodCount")
     def IexDividendsPeriodCount(self, symbol, periodrange):
         logger.debug("IexDividendsPeriodCount called")
-        return get_dividends_period_count(symbol, periodrange)
+        return _module("iex_dividends").get_dividends_period_count(symbol, periodrange)
 
+    @metrics.timed("impl.IexDividendsKeyByIndex")
     def IexDividendsKeyByIndex(self, index):
         logger.debug("IexDividendsKeyByIndex called %d", index)
-        return get_dividends_keyx(index)
+        return _module("iex_dividends").get_dividends_keyx(index)
 
+    @metrics.timed("impl.IexDividendsItem")
     def IexDividendsItem(self, symbol, key, period, periodrange):
         logger.debug("IexDividendsItem called %s %s %d %s", symbol, key, period, periodrange)
-        return get_dividends_item(symbol, key, period, periodrange)
+        return _module("iex_dividends").get_dividends_item(symbol, key, period, periodrange)
 
+    @metrics.timed("impl.IexDividendsTTM")
     def IexDividendsTTM(self, symbol, asofdate):
         logger.debug("IexDividendsTTM called %s %s", symbol, asofdate)
-        return get_dividends_ttm(symbol, asofdate)
+        return _module("iex_dividends").get_dividends_ttm(symbol, asofdate)
 
+    @metrics.timed("impl.IexEarningsKeyCount")
     def IexEarningsKeyCount(self):
         logger.debug("IexEarningsKeyCount called")
-        return get_earnings_key_count()
+        return _module("iex_earnings").get_earnings_key_count()
 
+    @metrics.timed("impl.IexEarningsKeyByIndex")
     def IexEarningsKeyByIndex(self, index):
         logger.debug("IexEarningsKeyByIndex called %d", index)
-        return get_earnings_keyx(index)
+        return _module("iex_earnings").get_earnings_keyx(index)
 
+    @metrics.timed("impl.IexEarningsItem")
     def IexEarningsItem(self, symbol, key, period):
         logger.debug("IexEarningsItem called %s %s %d", symbol, key, period)
-        return get_earnings_item(symbol, key, period)
+        return _module("iex_earnings").get_earnings_item(symbol, key, period)
 
+    @metrics.timed("impl.IexHistoricalQuote")
     def IexHistoricalQuote(self, symbol, fordate):
         logger.debug("IexHistoricalQuote called %s %s", symbol, fordate)
-        return get_closing_price(symbol, fordate)
+        return _module("iex_chart").get_closing_price(symbol, fordate)
+
+    @metrics.timed("impl.IexHistoricalItem")
+    def IexHistoricalItem(self, symbol, fordate, itemkey):
+        logger.debug("IexHistoricalItem called %s %s %s", symbol, fordate, itemkey)
+        return _module("iex_chart").get_historical_item(symbol, fordate, itemkey)
+
+    @metrics.timed("impl.IexHistoricalSeries")
+    def IexHistoricalSeries(self, symbol, startdate, enddate):
+        logger.debug("IexHistoricalSeries called %s %s %s", symbol, startdate, enddate)
+        return _module("iex_chart").get_historical_series(symbol, startdate, enddate)
+
+    def IexStats(self, metric):
+        logger.debug("IexStats called %s", metric)
+        return _module("iex_metrics").get_stats(metric)
 
 
 # Configuration lock. Used to deal with the fact that sometimes
@@ -18,6 +18,7 @@
 from iex_app_logger import AppLogger
 from iex_stocks import IEXStocks
 from iex_base import IEXBase
+from extn_helper import flatten_range
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -28,8 +29,9 @@ class IEXKeyStats(IEXBase):
 
     """
     def __init__(self):
-        super(IEXKeyStats, self).__init__()
+        super(IEXKeyStats, self).__init__("keystats")
         self.time_keys = []
+        self.batch_type = "stats"
         logger.debug("IEXKeyStats initialized")
 
     # The dervived class must override this method
@@ -42,16 +44,7 @@ class IEXKeyStats(IEXBase):
         :return:
         """
         symbol = symbol.upper()
-        res = self._get_cached_result(symbol)
-        if res:
-            logger.debug("KyeStats cache hit for %s", symbol)
-        else:
-            logger.debug("KeyStats cache miss for %s", symbol)
-            res = IEXStocks.get_stats(symbol)
-            if res["status_code"] == 200:
-                self._cache_result(symbol, res)
-                logger.debug("KeyStats cached for %s", symbol)
-        return res
+        return self._get_cached_or_fetch(symbol, lambda: IEXStocks.get_stats(symbol))
 
 # Singleton instance of the IEXKeyStats class
 keystats_inst = IEXKeyStats()
@@ -80,3 +73,12 @@ def get_keystats_item(symbol, key):
     """
     # This is a temporary solution for items that are Unix timestamps.
     return keystats_inst.get_result_item("stats", symbol, key)
+
+def get_keystats_table(symbols, keys):
+    """
+    Returns a table of key stats items with a row for each symbol and a column for each key.
+    :param symbols: Range of stock ticker symbols.
+    :param keys: Range of item keys.
+    :return: Tuple of row tuples
+    """
+    return keystats_inst.get_result_table("stats", flatten_range(symbols), flatten_range(keys))
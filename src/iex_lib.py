@@ -22,7 +22,7 @@ import inspect
 import datetime
 import json
 from iex_app_logger import AppLogger
-from url_helpers import setup_cacerts
+from url_helpers import setup_cacerts, setup_connection_pool, setup_rate_limiter, set_json_codec
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -47,9 +47,52 @@ class QConfiguration:
     full_file_path = ""
     cacerts = ""
     loglevel = "info"
+    # Write the log file from a background thread
+    queued_logging = True
     cwd = ""
     iex_conf_exists = False
     iex_cache_db = "~/libreoffice/iex/iex-cache-db.sqlite3"
+    # Idle keep-alive connections kept per host and how long (seconds) they are kept
+    pool_size = 4
+    pool_idle_timeout = 30
+    # Maximum requests per second sent to IEX (IEX allows 100 per IP, 0 for
+    # no limit), how many can be sent back to back and how often a request
+    # is retried when IEX answers 429 (Too Many Requests)
+    rate_limit = 100
+    rate_limit_burst = 20
+    max_retries = 3
+    # Longest Retry-After (seconds) waited out before retrying a 429
+    rate_limit_max_wait = 30
+    # JSON decoder for IEX responses: auto (fastest installed), json, orjson or ujson
+    json_codec = "auto"
+    # Limits for each category's in-memory result cache
+    cache_max_entries = 1000
+    cache_max_bytes = 16 * 1024 * 1024
+    # Time-to-live (seconds) of cached results by category
+    cache_ttl = {
+        "quote": 5 * 60,
+        "price": 60,
+        "company": 7 * 24 * 60 * 60,
+        "keystats": 24 * 60 * 60,
+        "dividends": 24 * 60 * 60,
+        "earnings": 24 * 60 * 60
+    }
+    default_cache_ttl = 5 * 60
+    # Seconds an expired result is still served while it is refreshed in
+    # the background (stale-while-revalidate), by category. Off by default.
+    stale_grace = {}
+    # Symbols whose data is prefetched in the background when the extension loads
+    watchlist_symbols = []
+    # quote, company, keystats and/or historical
+    watchlist_categories = ["quote", "company", "keystats"]
+    # Seconds between prefetch calls to IEX
+    watchlist_throttle = 0.5
+    # Keep a memory-mapped copy of the price history for fast lookups (requires numpy)
+    history_store = False
+    # Folder of the history store. Defaults to the history folder next to iex.conf.
+    history_store_path = ""
+    # Seconds between dumps of the metrics to iex-metrics.json. 0 disables dumping.
+    metrics_interval = 5 * 60
 
     @classmethod
     def load(cls):
@@ -64,32 +107,73 @@ class QConfiguration:
         cls.full_file_path = cls.file_path + file_name
 
         # Read iex.conf file
+        cfj = {}
         try:
             cf = open(cls.full_file_path, "r")
-            cfj = json.loads(cf.read())
-            if "loglevel" in cfj:
-                cls.loglevel = cfj["loglevel"]
-                the_app_logger.set_log_level(cls.loglevel)
-            if "cachedb" in cfj:
-                cls.iex_cache_db = cfj["cachedb"]
-            else:
-                # Default cache DB definition
-                file_name = "iex-cache-db.sqlite3"
-                if os.name == "posix":
-                    # Linux or OS X
-                    file_path = "{0}/libreoffice/iex/".format(os.environ["HOME"])
-                elif os.name == "nt":
-                    # windows
-                    file_path = "{0}\\libreoffice\\iex\\".format(os.environ["LOCALAPPDATA"])
-                cls.iex_cache_db = file_path + file_name
-            logger.info("Using cache db %s", cls.iex_cache_db)
-            cf.close()
+            # The file exists. Whatever it contains, it is never overwritten.
             cls.iex_conf_exists = True
+            try:
+                cfj = json.loads(cf.read())
+            finally:
+                cf.close()
+            if not isinstance(cfj, dict):
+                raise ValueError("iex.conf does not contain a JSON object")
         except FileNotFoundError as ex:
             logger.error("%s was not found", cls.full_file_path)
         except Exception as ex:
             logger.error("An exception occurred while attempting to load iex.conf")
             logger.error(str(ex))
+            cfj = {}
+
+        # Each setting is parsed on its own. An invalid value is logged and
+        # the setting keeps its default.
+        if "loglevel" in cfj:
+            cls.loglevel = cls._conf_value(cfj, "loglevel", str, cls.loglevel)
+            the_app_logger.set_log_level(cls.loglevel)
+        cls.queued_logging = cls._conf_value(cfj, "queuedlogging", bool, cls.queued_logging)
+        if "cachedb" in cfj:
+            cls.iex_cache_db = cfj["cachedb"]
+        else:
+            # Default cache DB definition
+            file_name = "iex-cache-db.sqlite3"
+            if os.name == "posix":
+                # Linux or OS X
+                file_path = "{0}/libreoffice/iex/".format(os.environ["HOME"])
+            elif os.name == "nt":
+                # windows
+                file_path = "{0}\\libreoffice\\iex\\".format(os.environ["LOCALAPPDATA"])
+            cls.iex_cache_db = file_path + file_name
+        logger.info("Using cache db %s", cls.iex_cache_db)
+        cls.pool_size = cls._conf_value(cfj, "poolsize", int, cls.pool_size)
+        cls.pool_idle_timeout = cls._conf_value(cfj, "poolidletimeout", float, cls.pool_idle_timeout)
+        cls.rate_limit = cls._conf_value(cfj, "ratelimit", float, cls.rate_limit)
+        cls.rate_limit_burst = cls._conf_value(cfj, "ratelimitburst", int, cls.rate_limit_burst)
+        cls.max_retries = cls._conf_value(cfj, "maxretries", int, cls.max_retries)
+        cls.rate_limit_max_wait = cls._conf_value(cfj, "ratelimitmaxwait", float, cls.rate_limit_max_wait)
+        if "jsoncodec" in cfj:
+            cls.json_codec = cfj["jsoncodec"]
+        cls.cache_max_entries = cls._conf_value(cfj, "cachemaxentries", int, cls.cache_max_entries)
+        cls.cache_max_bytes = cls._conf_value(cfj, "cachemaxbytes", int, cls.cache_max_bytes)
+        # Categories missing from iex.conf keep their defaults
+        cls._load_by_category(cfj, "cachettl", cls.cache_ttl)
+        cls._load_by_category(cfj, "stalewhilerevalidate", cls.stale_grace)
+        if "watchlist" in cfj:
+            watchlist = cfj["watchlist"]
+            if isinstance(watchlist, dict):
+                cls.watchlist_symbols = watchlist.get("symbols", [])
+                cls.watchlist_categories = watchlist.get("categories", cls.watchlist_categories)
+                cls.watchlist_throttle = cls._conf_value(watchlist, "throttle", float, cls.watchlist_throttle)
+            else:
+                logger.error("Ignoring invalid watchlist in iex.conf: %s", watchlist)
+        cls.history_store = cls._conf_value(cfj, "historystore", bool, cls.history_store)
+        if "historystorepath" in cfj:
+            cls.history_store_path = cfj["historystorepath"]
+        cls.metrics_interval = cls._conf_value(cfj, "metricsinterval", float, cls.metrics_interval)
+
+        the_app_logger.set_queued_logging(cls.queued_logging)
+
+        if not cls.history_store_path:
+            cls.history_store_path = cls.file_path + "history"
 
         # Set up path to certs
         cls.cwd = os.path.realpath(os.path.abspath
@@ -106,6 +190,9 @@ class QConfiguration:
         logger.debug("Path to cacert.pem: %s", cls.cacerts)
         # Attach the certs file to the URL processor
         setup_cacerts(cls.cacerts)
+        setup_connection_pool(cls.pool_size, cls.pool_idle_timeout)
+        setup_rate_limiter(cls.rate_limit, cls.rate_limit_burst, cls.max_retries, cls.rate_limit_max_wait)
+        set_json_codec(cls.json_codec)
 
         # If no iex.conf file exists, create one with all defaults
         if not cls.iex_conf_exists:
@@ -114,6 +201,45 @@ class QConfiguration:
             # This sets the log level to whatever default was set above.
             the_app_logger.set_log_level(cls.loglevel)
 
+    @classmethod
+    def _conf_value(cls, cfj, key, convert, default):
+        """
+        Return a setting from iex.conf converted to its type.
+        :param cfj: The iex.conf JSON object (or a nested object)
+        :param key: Name of the setting
+        :param convert: Type conversion, e.g. int or float
+        :param default: Value used when the setting is missing or invalid
+        :return: The converted value or default
+        """
+        if key not in cfj:
+            return default
+        try:
+            return convert(cfj[key])
+        except (TypeError, ValueError) as ex:
+            logger.error("Ignoring invalid %s value %s in iex.conf: %s", key, cfj[key], str(ex))
+            return default
+
+    @classmethod
+    def _load_by_category(cls, cfj, key, values):
+        """
+        Update a dict of seconds by category (e.g. cachettl) from iex.conf.
+        Invalid entries are logged and skipped.
+        :param cfj: The iex.conf JSON object
+        :param key: Name of the setting
+        :param values: Dict of category: seconds that is updated
+        :return: None
+        """
+        if key not in cfj:
+            return
+        if not isinstance(cfj[key], dict):
+            logger.error("Ignoring invalid %s value %s in iex.conf", key, cfj[key])
+            return
+        for category, seconds in cfj[key].items():
+            try:
+                values[category.lower()] = float(seconds)
+            except (TypeError, ValueError):
+                logger.error("Ignoring invalid %s value %s for %s in iex.conf", key, seconds, category)
+
     @classmethod
     def save(cls):
         """
@@ -128,6 +254,19 @@ class QConfiguration:
         conf = {}
         conf["certifi"] = cls.cacerts
         conf["loglevel"] = cls.loglevel
+        conf["queuedlogging"] = cls.queued_logging
+        conf["poolsize"] = cls.pool_size
+        conf["poolidletimeout"] = cls.pool_idle_timeout
+        conf["ratelimit"] = cls.rate_limit
+        conf["ratelimitburst"] = cls.rate_limit_burst
+        conf["maxretries"] = cls.max_retries
+        conf["ratelimitmaxwait"] = cls.rate_limit_max_wait
+        conf["jsoncodec"] = cls.json_codec
+        conf["cachemaxentries"] = cls.cache_max_entries
+        conf["cachemaxbytes"] = cls.cache_max_bytes
+        conf["cachettl"] = cls.cache_ttl
+        conf["metricsinterval"] = cls.metrics_interval
+        conf["historystore"] = cls.history_store
 
         logger.debug("Saving configuration to %s", cls.full_file_path)
         cf = open(cls.full_file_path, "w")
@@ -143,6 +282,24 @@ class QConfiguration:
 
         cls.iex_conf_exists = True
 
+    @classmethod
+    def get_cache_ttl(cls, category):
+        """
+        Returns the time-to-live for cached results of a category.
+        :param category: quote, price, company, keystats, dividends or earnings.
+        :return: TTL in seconds.
+        """
+        return cls.cache_ttl.get(category, cls.default_cache_ttl)
+
+    @classmethod
+    def get_stale_grace(cls, category):
+        """
+        Returns the stale-while-revalidate grace period of a category.
+        :param category: quote, price, company, keystats, dividends or earnings.
+        :return: Grace period in seconds. Zero if the category is not served stale.
+        """
+        return cls.stale_grace.get(category, 0)
+
     @classmethod
     def is_configured(cls):
         """
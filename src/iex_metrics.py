@@ -0,0 +1,233 @@
+#
+# iex_metrics - Counters and latency histograms for the IEX extension
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Metric names are dotted strings. For example:
+#   http.requests, http.status.200, http.latency
+#   cache.quote.hits, cache.quote.misses, cache.quote.stale
+#   cachedb.lookup_result_blob
+#   impl.IexQuoteItem
+#
+
+import os
+import time
+import json
+import bisect
+import threading
+import functools
+from iex_app_logger import AppLogger
+
+# Logger init
+the_app_logger = AppLogger("iex-extension")
+logger = the_app_logger.getAppLogger()
+
+
+class Histogram:
+    """
+    Latency histogram with fixed buckets. Percentiles are estimated
+    as the upper bound of the bucket that contains them.
+    """
+    # Bucket upper bounds in milliseconds. The last bucket is unbounded.
+    bounds = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+    def __init__(self):
+        self.buckets = [0] * (len(Histogram.bounds) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        self.buckets[bisect.bisect_left(Histogram.bounds, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def percentile(self, p):
+        """
+        Returns the estimated pth percentile in milliseconds.
+        :param p: 0 to 100
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                if i < len(Histogram.bounds):
+                    return float(min(Histogram.bounds[i], self.max_ms))
+                return self.max_ms
+        return self.max_ms
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p90_ms": round(self.percentile(90), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max_ms, 3)
+        }
+
+
+class Metrics:
+    """
+    Thread safe registry of counters and latency histograms
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {name: count}
+        self._counters = {}
+        # {name: Histogram}
+        self._histograms = {}
+        self.started = time.time()
+
+    def increment(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            h = self._histograms.get(name)
+            if h is None:
+                h = Histogram()
+                self._histograms[name] = h
+            h.observe(seconds * 1000.0)
+
+    def timed(self, name):
+        """
+        Decorator that records the latency of every call of a function.
+        :param name: Histogram name
+        :return:
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.observe(name, time.time() - start)
+            return wrapper
+        return decorator
+
+    def get(self, metric):
+        """
+        Returns the value of a metric.
+        :param metric: A counter name (e.g. http.requests), a histogram name
+        followed by count, mean_ms, p50_ms, p90_ms, p99_ms or max_ms
+        (e.g. http.latency.p90_ms) or cache.<category>.hit_ratio.
+        :return: The value or None if there is no such metric.
+        """
+        with self._lock:
+            if metric in self._counters:
+                return self._counters[metric]
+            name, _, stat = metric.rpartition(".")
+            if name in self._histograms:
+                return self._histograms[name].summary().get(stat)
+            if stat == "hit_ratio" and name.startswith("cache."):
+                hits = self._counters.get(name + ".hits", 0) + self._counters.get(name + ".stale", 0)
+                total = hits + self._counters.get(name + ".misses", 0)
+                return round(hits / total, 4) if total else 0.0
+            if metric == "uptime":
+                return round(time.time() - self.started, 1)
+        return None
+
+    def snapshot(self):
+        """
+        Returns every metric as a dict.
+        :return:
+        """
+        with self._lock:
+            return {
+                "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                "uptime": round(time.time() - self.started, 1),
+                "counters": dict(self._counters),
+                "latency": {name: h.summary() for name, h in self._histograms.items()}
+            }
+
+    def dump(self, file_name):
+        """
+        Write a snapshot of all metrics as JSON. The file is replaced atomically.
+        :param file_name: Full path of the JSON file
+        :return: None
+        """
+        tmp = file_name + ".tmp"
+        fh = open(tmp, "w")
+        json.dump(self.snapshot(), fh, indent=4, sort_keys=True)
+        fh.close()
+        os.replace(tmp, file_name)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+
+class MetricsDumper(threading.Thread):
+    """
+    Writes the metrics to a JSON file at a fixed interval
+    """
+    def __init__(self, file_name, interval):
+        threading.Thread.__init__(self, name="iex-metrics")
+        self.daemon = True
+        self.file_name = file_name
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def cancel(self):
+        self._stop_event.set()
+
+    def run(self):
+        logger.info("Dumping metrics to %s every %s seconds", self.file_name, self.interval)
+        while not self._stop_event.wait(self.interval):
+            try:
+                metrics.dump(self.file_name)
+            except Exception as ex:
+                logger.error("Unable to dump metrics: %s", str(ex))
+
+
+# Singleton instance of the Metrics class
+metrics = Metrics()
+metrics_dumper = None
+
+
+def start_metrics_dump(file_name, interval):
+    """
+    Start dumping metrics periodically.
+    :param file_name: Full path of the JSON file
+    :param interval: Seconds between dumps. 0 disables dumping.
+    :return: None
+    """
+    global metrics_dumper
+    if interval <= 0 or metrics_dumper is not None:
+        return
+    metrics_dumper = MetricsDumper(file_name, interval)
+    metrics_dumper.start()
+
+
+def get_stats(metric):
+    """
+    Returns the value of a metric for the IexStats function.
+    :param metric: Metric name
+    :return: The value or an error message
+    """
+    v = metrics.get(metric.strip())
+    if v is None:
+        return "Invalid metric"
+    return v
@@ -0,0 +1,144 @@
+#
+# iex_prefetch - Background watchlist prefetch
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import atexit
+import threading
+from datetime import date, timedelta
+from iex_app_logger import AppLogger
+from iex_lib import QConfiguration
+from iex_base import IEXBase
+
+# Logger init
+the_app_logger = AppLogger("iex-extension")
+logger = the_app_logger.getAppLogger()
+
+
+class WatchlistPrefetcher(threading.Thread):
+    """
+    Daemon thread that warms the result caches and the historical price
+    cache for a list of symbols so the first recalc of a sheet finds the
+    data already there.
+    """
+    # Watchlist categories that are fetched through the market batch API
+    batch_categories = ["quote", "company", "keystats"]
+
+    def __init__(self, symbols, categories, throttle):
+        """
+        :param symbols: List of ticker symbols.
+        :param categories: List of quote, company, keystats and/or historical.
+        :param throttle: Seconds to wait between IEX calls.
+        """
+        super(WatchlistPrefetcher, self).__init__(name="iex-watchlist-prefetch")
+        self.daemon = True
+        self.symbols = [s.upper() for s in symbols]
+        self.categories = [c.lower() for c in categories]
+        self.throttle = throttle
+        self._cancel = threading.Event()
+        # Number of symbols warmed by category
+        self.warmed = {}
+
+    def cancel(self):
+        """
+        Ask the prefetch to stop. It stops before its next IEX call.
+        :return: None
+        """
+        self._cancel.set()
+
+    def is_cancelled(self):
+        return self._cancel.is_set()
+
+    def run(self):
+        logger.info("Watchlist prefetch started for %d symbols: %s", len(self.symbols), ", ".join(self.categories))
+        for category in self.categories:
+            if self.is_cancelled():
+                break
+            try:
+                if category in WatchlistPrefetcher.batch_categories:
+                    self._warm_results(category)
+                elif category == "historical":
+                    self._warm_historical()
+                else:
+                    logger.error("Unknown watchlist category %s", category)
+            except Exception as ex:
+                logger.error("Watchlist prefetch of %s failed", category)
+                logger.error(str(ex))
+        logger.info("Watchlist prefetch %s: %s", "cancelled" if self.is_cancelled() else "complete",
+                    self.report())
+
+    def report(self):
+        """
+        Describe what has been warmed.
+        :return: String like "quote 20, company 20"
+        """
+        return ", ".join(["{0} {1}".format(c, self.warmed[c]) for c in self.categories if c in self.warmed])
+
+    def _warm_results(self, category):
+        # Imported here so the category singletons are created on this thread
+        if category == "quote":
+            from iex_quote import quote_inst as inst
+        elif category == "company":
+            from iex_company import company_inst as inst
+        else:
+            from iex_keystats import keystats_inst as inst
+
+        self.warmed[category] = 0
+        for i in range(0, len(self.symbols), IEXBase.batch_symbol_limit):
+            if self._cancel.wait(self.throttle if i else 0):
+                return
+            self.warmed[category] += inst.prefetch_results(self.symbols[i:i + IEXBase.batch_symbol_limit])
+
+    def _warm_historical(self):
+        from iex_chart import IEXChart
+        today = date.today()
+        start_date = (today - timedelta(days=IEXChart.chart_period_days["5y"])).isoformat()
+        self.warmed["historical"] = 0
+        for symbol in self.symbols:
+            if self._cancel.wait(self.throttle):
+                return
+            rows = IEXChart.get_closing_prices_for_range(symbol, start_date, today.isoformat())
+            if isinstance(rows, str):
+                logger.error("Watchlist historical prefetch for %s failed: %s", symbol, rows)
+            else:
+                self.warmed["historical"] += 1
+
+
+# The running prefetch (if any)
+prefetcher = None
+
+def start_watchlist_prefetch():
+    """
+    Start warming caches for the watchlist in iex.conf.
+    :return: The prefetch thread or None if there is no watchlist.
+    """
+    global prefetcher
+    if not QConfiguration.watchlist_symbols or (prefetcher and prefetcher.is_alive()):
+        return prefetcher
+    prefetcher = WatchlistPrefetcher(QConfiguration.watchlist_symbols, QConfiguration.watchlist_categories,
+                                     QConfiguration.watchlist_throttle)
+    prefetcher.start()
+    return prefetcher
+
+def stop_watchlist_prefetch():
+    """
+    Cancel the watchlist prefetch if it is running.
+    :return: None
+    """
+    if prefetcher and prefetcher.is_alive():
+        logger.info("Cancelling watchlist prefetch")
+        prefetcher.cancel()
+
+atexit.register(stop_watchlist_prefetch)
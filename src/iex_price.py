@@ -17,18 +17,43 @@
 
 from iex_app_logger import AppLogger
 from iex_stocks import IEXStocks
+from iex_base import IEXBase
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
 logger = the_app_logger.getAppLogger()
 
+class IEXPrice(IEXBase):
+    """
+
+    """
+    def __init__(self):
+        super(IEXPrice, self).__init__("price")
+        self.time_keys = []
+        logger.debug("IEXPrice initialized")
+
+    # The dervived class must override this method
+    def _get_result_for_symbol(self, symbol):
+        """
+        Returns a result for a given stock ticker symbol. This method
+        MUST be overriden by the derived class so it gets the result
+        specific to the derived class.
+        :param symbol: The target stock ticker symbol.
+        :return:
+        """
+        symbol = symbol.upper()
+        return self._get_cached_or_fetch(symbol, lambda: IEXStocks.get_price(symbol))
+
+# Singleton instance of the IEXPrice class
+price_inst = IEXPrice()
+
 def get_price(symbol):
     """
     Returns the current price for a stock symbol using the IEX price API call.
     :param symbol: Target stock ticker symbol.
     :return: Price or error message
     """
-    res = IEXStocks.get_price(symbol)
+    res = price_inst._get_result_for_symbol(symbol)
     if res["status_code"] == 200:
         return float(res["result"])
     return res["error_message"]
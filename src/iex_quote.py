@@ -18,6 +18,7 @@
 from iex_app_logger import AppLogger
 from iex_stocks import IEXStocks
 from iex_base import IEXBase
+from extn_helper import flatten_range
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
@@ -28,8 +29,9 @@ class IEXQuote(IEXBase):
 
     """
     def __init__(self):
-        super(IEXQuote, self).__init__()
+        super(IEXQuote, self).__init__("quote")
         self.time_keys = ["openTime", "closeTime", "latestUpdate", "iexLastUpdated", "delayedPriceTime"]
+        self.batch_type = "quote"
         logger.debug("IEXQuote initialized")
 
     # TODO The dervived class must override this method
@@ -42,16 +44,7 @@ class IEXQuote(IEXBase):
         :return:
         """
         symbol = symbol.upper()
-        res = self._get_cached_result(symbol)
-        if res:
-            logger.debug("Quote cache hit for %s", symbol)
-        else:
-            logger.debug("Quote cache miss for %s", symbol)
-            res = IEXStocks.get_quote(symbol)
-            if res["status_code"] == 200:
-                self._cache_result(symbol, res)
-                logger.debug("Quote cached for %s", symbol)
-        return res
+        return self._get_cached_or_fetch(symbol, lambda: IEXStocks.get_quote(symbol))
 
 # Singleton instance of the IEXQuote class
 quote_inst = IEXQuote()
@@ -80,3 +73,12 @@ def get_quote_item(symbol, key):
     """
     # This is a temporary solution for items that are Unix timestamps.
     return quote_inst.get_result_item("quote", symbol, key)
+
+def get_quote_table(symbols, keys):
+    """
+    Returns a table of quote items with a row for each symbol and a column for each key.
+    :param symbols: Range of stock ticker symbols.
+    :param keys: Range of item keys.
+    :return: Tuple of row tuples
+    """
+    return quote_inst.get_result_table("quote", flatten_range(symbols), flatten_range(keys))
@@ -0,0 +1,161 @@
+#
+# iex_schema - Registry of the item keys in each IEX result category
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import threading
+from iex_app_logger import AppLogger
+from cache_db import CacheDB
+
+# Logger init
+the_app_logger = AppLogger("iex-extension")
+logger = the_app_logger.getAppLogger()
+
+# Item keys of each category as documented by IEX. These are used until the
+# keys have been discovered from an actual IEX result.
+# See https://iextrading.com/developer/docs/#stocks
+DEFAULT_RESULT_KEYS = {
+    "quote": [
+        "symbol", "companyName", "primaryExchange", "sector", "calculationPrice", "open", "openTime",
+        "close", "closeTime", "high", "low", "latestPrice", "latestSource", "latestTime", "latestUpdate",
+        "latestVolume", "iexRealtimePrice", "iexRealtimeSize", "iexLastUpdated", "delayedPrice",
+        "delayedPriceTime", "extendedPrice", "extendedChange", "extendedChangePercent", "extendedPriceTime",
+        "previousClose", "change", "changePercent", "iexMarketPercent", "iexVolume", "avgTotalVolume",
+        "iexBidPrice", "iexBidSize", "iexAskPrice", "iexAskSize", "marketCap", "peRatio", "week52High",
+        "week52Low", "ytdChange"
+    ],
+    "company": [
+        "symbol", "companyName", "exchange", "industry", "website", "description", "CEO", "issueType",
+        "sector", "tags"
+    ],
+    "keystats": [
+        "companyName", "marketcap", "beta", "week52high", "week52low", "week52change", "shortInterest",
+        "shortDate", "dividendRate", "dividendYield", "exDividendDate", "latestEPS", "latestEPSDate",
+        "sharesOutstanding", "float", "returnOnEquity", "consensusEPS", "numberOfEstimates",
+        "EPSSurpriseDollar", "EPSSurprisePercent", "symbol", "EBITDA", "revenue", "grossProfit", "cash",
+        "debt", "ttmEPS", "revenuePerShare", "revenuePerEmployee", "peRatioHigh", "peRatioLow",
+        "returnOnAssets", "returnOnCapital", "profitMargin", "priceToSales", "priceToBook",
+        "day200MovingAvg", "day50MovingAvg", "institutionPercent", "insiderPercent", "shortRatio",
+        "year5ChangePercent", "year2ChangePercent", "year1ChangePercent", "ytdChangePercent",
+        "month6ChangePercent", "month3ChangePercent", "month1ChangePercent", "day5ChangePercent",
+        "day30ChangePercent"
+    ],
+    "dividends": [
+        "exDate", "paymentDate", "recordDate", "declaredDate", "amount", "flag", "type", "qualified",
+        "indicated"
+    ],
+    "earnings": [
+        "actualEPS", "consensusEPS", "estimatedEPS", "announceTime", "numberOfEstimates",
+        "EPSSurpriseDollar", "EPSReportDate", "fiscalPeriod", "fiscalEndDate", "yearAgo",
+        "yearAgoChangePercent", "estimatedChangePercent", "symbolId"
+    ]
+}
+
+
+class SchemaRegistry:
+    """
+    Knows the item keys of each result category without calling IEX. Keys
+    start out as the shipped defaults (or whatever was persisted in the cache
+    DB). Whenever a result arrives from IEX its keys are merged in and the
+    updated key list is persisted.
+    """
+    def __init__(self):
+        # {category: sorted key list}
+        self._keys = {}
+        # {category: frozenset of keys} for validation
+        self._index = {}
+        # Categories whose keys have been confirmed by an IEX result
+        self._discovered = set()
+        self._lock = threading.Lock()
+
+    def get_keys(self, category):
+        """
+        Returns the item keys of a category.
+        :param category: quote, company, keystats, dividends or earnings
+        :return: List of keys sorted case insensitive.
+        """
+        keys = self._keys.get(category)
+        if keys is None:
+            with self._lock:
+                keys = self._load(category)
+        return keys
+
+    def is_valid_key(self, category, key):
+        """
+        Answers the question: Is key an item key of the category?
+        :param category:
+        :param key:
+        :return: True or False
+        """
+        index = self._index.get(category)
+        if index is None:
+            self.get_keys(category)
+            index = self._index[category]
+        return key in index
+
+    def observe(self, category, keys):
+        """
+        Merge the keys of an IEX result into the registry. The first result
+        seen for a category replaces the shipped defaults.
+        :param category:
+        :param keys: Iterable of keys from an IEX result.
+        :return: None
+        """
+        keys = frozenset(keys)
+        if category in self._discovered and keys <= self._index.get(category, frozenset()):
+            # Nothing new. This is the common case.
+            return
+
+        with self._lock:
+            self._load(category)
+            if category in self._discovered:
+                keys = keys | self._index[category]
+            self._discovered.add(category)
+            if keys == self._index[category]:
+                return
+            self._set(category, keys)
+            logger.info("Discovered %d %s keys", len(keys), category)
+            try:
+                CacheDB.insert_result_keys(category, json.dumps(self._keys[category]))
+            except Exception as ex:
+                logger.error("Unable to persist %s keys: %s", category, str(ex))
+
+    # The following methods must be called while holding the lock
+
+    def _load(self, category):
+        keys = self._keys.get(category)
+        if keys is not None:
+            return keys
+        keys = DEFAULT_RESULT_KEYS.get(category, [])
+        try:
+            r = CacheDB.lookup_result_keys(category)
+            if r:
+                keys = json.loads(r["Keys"])
+                self._discovered.add(category)
+        except Exception as ex:
+            logger.error("Unable to load %s keys: %s", category, str(ex))
+        return self._set(category, keys)
+
+    def _set(self, category, keys):
+        # Sort keys case insensitive. Avoids randomized list of keys.
+        sorted_keys = sorted(keys, key=lambda k: k.lower())
+        self._index[category] = frozenset(sorted_keys)
+        self._keys[category] = sorted_keys
+        return sorted_keys
+
+
+# Singleton instance of the SchemaRegistry class
+schema_registry = SchemaRegistry()
@@ -17,29 +17,609 @@
 # For terms and conditions of IEX use see https://iextrading.com/api-exhibit-a
 #
 
-import urllib.request
+import logging
 import urllib.parse
-import urllib.error
+import urllib.request
+import http.client
+import base64
 
 import ssl
 import json
+import sys
+import zlib
+import codecs
+import threading
+import time
+import random
+import email.utils
 from iex_app_logger import AppLogger
+from iex_metrics import metrics
 
 # Logger init
 the_app_logger = AppLogger("iex-extension")
 logger = the_app_logger.getAppLogger()
 
+# SSL context shared by every HTTPS connection. It is built from the
+# CA certificates file on first use.
+ssl_ctx = None
+cacerts_file = None
+ssl_lock = threading.Lock()
+
+# Longest payload (characters) written to the log. Charts can be megabytes.
+max_logged_payload = 512
+
+# Bytes read from the socket at a time while decompressing a response
+read_chunk_size = 64 * 1024
+
+# JSON decoder used by exec_request. A faster codec is used if one is
+# installed (see set_json_codec).
+json_codec = "json"
+json_loads = json.loads
+# json.loads only accepts bytes from Python 3.6 on
+json_loads_bytes = sys.version_info >= (3, 6)
+
+
+def set_json_codec(codec):
+    """
+    Choose the JSON decoder for IEX responses.
+    :param codec: json, orjson, ujson or auto (the fastest one installed)
+    :return: The name of the codec in use
+    """
+    global json_codec, json_loads, json_loads_bytes
+    candidates = ["orjson", "ujson", "json"] if codec == "auto" else [codec, "json"]
+    for name in candidates:
+        try:
+            if name == "orjson":
+                import orjson
+                json_loads, json_loads_bytes = orjson.loads, True
+            elif name == "ujson":
+                import ujson
+                json_loads, json_loads_bytes = ujson.loads, True
+            else:
+                json_loads, json_loads_bytes = json.loads, sys.version_info >= (3, 6)
+            json_codec = name
+            break
+        except ImportError:
+            logger.debug("JSON codec %s is not installed", name)
+    logger.debug("Using JSON codec %s", json_codec)
+    return json_codec
+
+
+class ConnectionPool:
+    """
+    Keeps idle keep-alive HTTP(S) connections per host so consecutive
+    requests skip the TCP connect and TLS handshake. A connection is
+    owned by exactly one caller between acquire() and release().
+    """
+    def __init__(self, max_size=4, idle_timeout=30.0, timeout=30.0):
+        # Maximum number of idle connections kept per host
+        self.max_size = max_size
+        # Idle connections older than this (seconds) are closed
+        self.idle_timeout = idle_timeout
+        # Socket timeout for new connections
+        self.timeout = timeout
+        # {(scheme, host, port): [(connection, last_used), ...]}
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, scheme, host, port):
+        """
+        Get a connection to a host. An idle connection is reused if one is available.
+        :param scheme: http or https
+        :param host:
+        :param port: None for the scheme's default port
+        :return: Tuple (connection, reused)
+        """
+        key = (scheme, host, port)
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                conn, last_used = idle.pop()
+                if now - last_used <= self.idle_timeout:
+                    return conn, True
+                conn.close()
+
+        proxy = _proxy_for(scheme, host)
+        if proxy is None:
+            if scheme == "https":
+                conn = http.client.HTTPSConnection(host, port, timeout=self.timeout, context=get_ssl_context())
+            else:
+                conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+            conn.proxy_headers = None
+            logger.debug("New connection to %s://%s", scheme, host)
+            return conn, False
+
+        proxy_host, proxy_port, proxy_headers = proxy
+        if scheme == "https":
+            # TLS to the host through a CONNECT tunnel
+            conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=self.timeout,
+                                               context=get_ssl_context())
+            conn.set_tunnel(host, port, headers=proxy_headers)
+            conn.proxy_headers = None
+        else:
+            # Requests are sent to the proxy with the absolute URL
+            conn = http.client.HTTPConnection(proxy_host, proxy_port, timeout=self.timeout)
+            conn.proxy_headers = proxy_headers
+        logger.debug("New connection to %s://%s through proxy %s:%s", scheme, host, proxy_host, proxy_port)
+        return conn, False
+
+    def release(self, scheme, host, port, conn):
+        """
+        Return a connection to the pool. If the host already has max_size
+        idle connections the connection is closed.
+        :return: None
+        """
+        key = (scheme, host, port)
+        now = time.time()
+        expired = []
+        with self._lock:
+            # Evict idle connections while we are here
+            idle = []
+            for c, last_used in self._idle.get(key, []):
+                if now - last_used <= self.idle_timeout:
+                    idle.append((c, last_used))
+                else:
+                    expired.append(c)
+            if len(idle) < self.max_size:
+                idle.append((conn, now))
+            else:
+                expired.append(conn)
+            self._idle[key] = idle
+        for c in expired:
+            c.close()
+
+    def clear(self):
+        """
+        Close all idle connections.
+        :return: None
+        """
+        with self._lock:
+            for idle in self._idle.values():
+                for conn, last_used in idle:
+                    conn.close()
+            self._idle = {}
+
+
+def _proxy_for(scheme, host):
+    """
+    Returns the proxy for a host. Proxies are found the way urllib's
+    ProxyHandler finds them: the environment (e.g. HTTPS_PROXY, NO_PROXY)
+    and the system proxy settings.
+    :param scheme: http or https
+    :param host:
+    :return: Tuple (proxy host, proxy port, headers for the proxy) or None for a direct connection
+    """
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    if "://" not in proxy:
+        proxy = "http://" + proxy
+    parts = urllib.parse.urlsplit(proxy)
+    headers = {}
+    if parts.username:
+        credentials = "{0}:{1}".format(urllib.parse.unquote(parts.username),
+                                       urllib.parse.unquote(parts.password or ""))
+        headers["Proxy-Authorization"] = "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")
+    return parts.hostname, parts.port or 80, headers
+
+
+# The connection pool behind exec_request
+connection_pool = ConnectionPool()
+
+
+class RateLimiter:
+    """
+    Token bucket that keeps requests under the IEX request limit. Callers
+    are served in arrival order, so a burst of calls from one thread
+    cannot starve the others. The rate adapts to the service:
+    it is halved each time IEX answers 429 (Too Many Requests) and grows back
+    a step at a time with each successful request (AIMD).
+    """
+    # Lowest rate (requests/second) the limiter backs off to, unless the
+    # configured rate is lower still
+    min_rate = 1.0
+    # Successful requests it takes to grow from min_rate back to the configured rate
+    recovery_requests = 20
+
+    def __init__(self, rate=100.0, burst=20, max_retries=3, max_wait=30.0):
+        # Configured requests/second. 0 disables limiting.
+        self.max_rate = float(rate)
+        # Current (adapted) requests/second
+        self.rate = float(rate)
+        # Most requests that can be made back to back
+        self.burst = max(1, int(burst))
+        # How many times a request is retried after a 429
+        self.max_retries = max_retries
+        # Longest Retry-After (seconds) honored. A request asked to wait
+        # longer fails with the 429 instead of blocking its caller.
+        self.max_wait = float(max_wait)
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        # No requests are made before this time (Retry-After)
+        self._blocked_until = 0.0
+        # FIFO tickets. A caller waits until its ticket is being served.
+        self._next_ticket = 0
+        self._serving = 0
+        self._cond = threading.Condition()
+
+    def configure(self, rate, burst, max_retries, max_wait):
+        with self._cond:
+            self.max_rate = float(rate)
+            self.rate = float(rate)
+            self.burst = max(1, int(burst))
+            self.max_retries = max_retries
+            self.max_wait = float(max_wait)
+            self._tokens = min(self._tokens, float(self.burst))
+            self._cond.notify_all()
+
+    def _refill(self, now):
+        self._tokens = min(float(self.burst), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self):
+        """
+        Wait for permission to make a request.
+        :return: Seconds spent waiting
+        """
+        start = time.monotonic()
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while True:
+                if self.max_rate <= 0:
+                    # Limiting is off. Keep the ticket sequence consistent.
+                    self._serving = max(self._serving, ticket + 1)
+                    self._cond.notify_all()
+                    break
+                wait = None
+                if ticket == self._serving:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._blocked_until - now
+                    if wait <= 0:
+                        if self._tokens >= 1.0:
+                            self._tokens -= 1.0
+                            self._serving += 1
+                            # The next caller in line may have a token waiting for it
+                            self._cond.notify_all()
+                            break
+                        wait = (1.0 - self._tokens) / self.rate
+                self._cond.wait(wait)
+        return time.monotonic() - start
+
+    def throttled(self, retry_after):
+        """
+        IEX answered 429. Halve the rate and stop all requests for a while.
+        A Retry-After longer than max_wait is not honored: nothing is
+        blocked, since every caller (including the UI thread) would wait.
+        :param retry_after: Seconds to wait (from Retry-After) or None
+        :return: True if the request can be retried, False if IEX asked
+        for a longer wait than max_wait
+        """
+        with self._cond:
+            # Never back off to a rate above the configured one
+            floor = min(RateLimiter.min_rate, self.max_rate) if self.max_rate > 0 else RateLimiter.min_rate
+            self.rate = max(floor, self.rate / 2.0)
+            if retry_after is not None and retry_after > self.max_wait:
+                logger.warning("Throttled by IEX: rate reduced to %.1f requests/s, "
+                               "Retry-After of %.1f s exceeds the %.1f s limit",
+                               self.rate, retry_after, self.max_wait)
+                return False
+            if retry_after is None:
+                # One token's worth at the reduced rate, with jitter so
+                # callers that were throttled together do not return together
+                retry_after = (1.0 + random.random()) / self.rate
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self._tokens = 0.0
+            logger.warning("Throttled by IEX: rate reduced to %.1f requests/s for %.1f s",
+                           self.rate, retry_after)
+            return True
+
+    def succeeded(self):
+        """
+        A request went through. Grow the rate back toward the configured rate.
+        :return: None
+        """
+        if self.rate < self.max_rate:
+            with self._cond:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / RateLimiter.recovery_requests)
+
+
+# Keeps exec_request within the IEX request limit
+rate_limiter = RateLimiter()
+
 
 def setup_cacerts(cacerts):
     """
-    Set up SSL for the given URL.
-    :param url_string:
+    Set up SSL using the given CA certificates file. Loading the certificates
+    is deferred until the first HTTPS connection is made.
+    :param cacerts: Path to the CA certificates file.
+    :return: None
+    """
+    global ssl_ctx, cacerts_file
+    with ssl_lock:
+        cacerts_file = cacerts
+        ssl_ctx = None
+    # Connections made before this point used a different context
+    connection_pool.clear()
+
+
+def get_ssl_context():
+    """
+    Returns the SSL context for HTTPS connections, building it on first use.
+    :return: ssl.SSLContext
+    """
+    global ssl_ctx
+    with ssl_lock:
+        if ssl_ctx is None:
+            ssl_ctx = ssl.create_default_context(cafile=cacerts_file)
+            logger.debug("SSL context created from %s", cacerts_file)
+        return ssl_ctx
+
+
+def setup_connection_pool(max_size, idle_timeout):
+    """
+    Configure the connection pool used by exec_request.
+    :param max_size: Maximum number of idle connections kept per host.
+    :param idle_timeout: Seconds an idle connection is kept before it is closed.
+    :return: None
+    """
+    connection_pool.max_size = max_size
+    connection_pool.idle_timeout = idle_timeout
+    logger.debug("Connection pool size %d, idle timeout %s", max_size, idle_timeout)
+
+
+def setup_rate_limiter(rate, burst, max_retries, max_wait):
+    """
+    Configure the rate limiter used by exec_request.
+    :param rate: Maximum requests per second. 0 disables rate limiting.
+    :param burst: Maximum number of requests made back to back.
+    :param max_retries: Number of times a request is retried after a 429 (Too Many Requests).
+    :param max_wait: Longest Retry-After (seconds) waited out before a retry.
+    :return: None
+    """
+    rate_limiter.configure(rate, burst, max_retries, max_wait)
+    logger.debug("Rate limit %s requests/s, burst %d, %d retries, %s s max wait",
+                 rate, burst, max_retries, max_wait)
+
+
+def _retry_after(value):
+    """
+    Returns the seconds to wait given by a Retry-After header.
+    :param value: Header value. Either seconds or an HTTP date.
+    :return: Seconds or None if there is no usable value
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.mktime_tz(email.utils.parsedate_tz(value)) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+def _http_get(url_string, redirects=3):
+    """
+    Issue a GET request over a pooled connection. A reused connection that
+    turns out to be stale (closed by the server) is replaced once.
+    The response body is not read.
+    :param url_string: Fully encoded URL.
+    :param redirects: Number of redirects that will be followed.
+    :return: Tuple (connection, response). Pass both to _finish_response
+    when done with the body.
+    """
+    parts = urllib.parse.urlsplit(url_string)
+    path = parts.path or "/"
+    if parts.query:
+        path = path + "?" + parts.query
+
+    while True:
+        conn, reused = connection_pool.acquire(parts.scheme, parts.hostname, parts.port)
+        headers = {"Connection": "keep-alive", "Accept-Encoding": "gzip, deflate"}
+        target = path
+        if conn.proxy_headers is not None:
+            # Plain HTTP through a proxy
+            headers.update(conn.proxy_headers)
+            target = url_string
+        try:
+            conn.request("GET", target, headers=headers)
+            response = conn.getresponse()
+            break
+        except (http.client.HTTPException, OSError) as ex:
+            conn.close()
+            if not reused:
+                raise
+            # Stale keep-alive connection. Try again with a fresh one.
+            logger.debug("Stale connection to %s (%s), reconnecting", parts.hostname, str(ex))
+    # Remember where the connection goes back to
+    conn.pool_key = (parts.scheme, parts.hostname, parts.port)
+
+    location = response.getheader("Location")
+    if response.status in (301, 302, 303, 307, 308) and location and redirects > 0:
+        logger.debug("Redirected to %s", location)
+        response.read()
+        _finish_response(conn, response, True)
+        return _http_get(urllib.parse.urljoin(url_string, location), redirects - 1)
+
+    return conn, response
+
+
+def _finish_response(conn, response, complete):
+    """
+    Return a connection to the pool, or close it if it can't be reused.
+    :param conn: Connection from _http_get
+    :param response: Its response
+    :param complete: True if the whole body was read. A connection with
+    unread body data can't be used for another request.
     :return: None
     """
-    ssl_ctx = ssl.create_default_context(cafile=cacerts)
-    httpshandler = urllib.request.HTTPSHandler(context=ssl_ctx)
-    opener = urllib.request.build_opener(httpshandler)
-    urllib.request.install_opener(opener)
+    if complete and not response.will_close:
+        connection_pool.release(conn.pool_key[0], conn.pool_key[1], conn.pool_key[2], conn)
+    else:
+        conn.close()
+
+
+def _iter_body(response):
+    """
+    Yields a response body in chunks as it arrives, decompressing it if the
+    server compressed it. Only the chunk in hand is held in memory.
+    :param response: http.client.HTTPResponse
+    :return: Generator of bytes
+    """
+    encoding = (response.getheader("Content-Encoding") or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == "deflate":
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = None
+
+    first = True
+    while True:
+        chunk = response.read(read_chunk_size)
+        if not chunk:
+            break
+        metrics.increment("http.bytes_received", len(chunk))
+        if decompressor is None:
+            yield chunk
+            continue
+        if first and encoding == "deflate" and (chunk[0] & 0x0f) != 8:
+            # Some servers send raw deflate data without the zlib header
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        first = False
+        # Limit each piece of output. Chart data compresses about 10:1.
+        data = decompressor.decompress(chunk, read_chunk_size)
+        while data:
+            yield data
+            data = decompressor.decompress(decompressor.unconsumed_tail, read_chunk_size)
+    if decompressor is not None:
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def _read_body(response):
+    """
+    Read a whole response body, decompressing it if the server compressed it.
+    :param response: http.client.HTTPResponse
+    :return: The body as bytes
+    """
+    return b"".join(_iter_body(response))
+
+
+def iter_json_array(chunks):
+    """
+    Yields the elements of a JSON array one at a time as its text arrives.
+    Only the element being decoded is held in memory, not the whole array.
+    :param chunks: Iterable of bytes making up a JSON array (UTF-8)
+    :return: Generator of decoded elements
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+    in_array = False
+
+    while True:
+        # Skip whitespace, the opening bracket and separators
+        while pos < len(buf) and (buf[pos].isspace() or buf[pos] == ","
+                                  or (buf[pos] == "[" and not in_array)):
+            if buf[pos] == "[":
+                in_array = True
+            pos += 1
+        if pos < len(buf):
+            if not in_array:
+                raise ValueError("Payload is not a JSON array")
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+                # The element is complete only if a separator follows it. A number
+                # at the end of the buffer (e.g. 1.5 of 1.5e3) may continue in the next chunk.
+                follow = end
+                while follow < len(buf) and buf[follow].isspace():
+                    follow += 1
+                if (follow < len(buf) and buf[follow] in ",]") or eof:
+                    yield item
+                    pos = end
+                    continue
+            except ValueError:
+                if eof:
+                    raise
+        elif eof:
+            raise ValueError("Payload ended before the end of the JSON array")
+
+        # Need more text. Drop what has been decoded.
+        buf = buf[pos:]
+        pos = 0
+        chunk = next(chunks, None)
+        if chunk is None:
+            eof = True
+            buf += text_decoder.decode(b"", final=True)
+        else:
+            buf += text_decoder.decode(chunk)
+
+
+def _summarize_payload(payload, result=None):
+    """
+    Returns a payload for logging, truncated to max_logged_payload characters.
+    :param payload: Payload as returned by IEX (bytes)
+    :param result: Decoded payload, if there is one
+    :return: The payload or its first part and a summary of it
+    """
+    text = str(payload[:max_logged_payload], "utf-8", "replace")
+    if len(payload) <= max_logged_payload:
+        return text
+    if isinstance(result, list):
+        shape = "{0} items".format(len(result))
+    elif isinstance(result, dict):
+        shape = "{0} keys".format(len(result))
+    else:
+        shape = "not decoded"
+    return "{0}... ({1}, {2} bytes)".format(text, shape, len(payload))
+
+
+def _send_request(url_enc):
+    """
+    Send a GET request within the rate limit. Requests answered 429
+    (Too Many Requests) are retried after backing off, unless IEX asks
+    for a longer wait than the rate limiter allows.
+    :param url_enc: Fully encoded URL.
+    :return: Tuple (connection, response) as returned by _http_get
+    """
+    attempt = 0
+    while True:
+        metrics.observe("http.ratelimit_wait", rate_limiter.acquire())
+        metrics.increment("http.requests")
+        try:
+            conn, response = _http_get(url_enc)
+        except Exception:
+            metrics.increment("http.failures")
+            raise
+        status_code = response.status
+        metrics.increment("http.status.{0}".format(status_code))
+        if status_code != 429:
+            rate_limiter.succeeded()
+            return conn, response
+        retry = rate_limiter.throttled(_retry_after(response.getheader("Retry-After")))
+        if not retry or attempt >= rate_limiter.max_retries:
+            return conn, response
+        response.read()
+        _finish_response(conn, response, True)
+        attempt += 1
+        logger.debug("Retry %d of %s", attempt, url_enc)
+
+
+def _encode_url(url_string, parms):
+    if parms:
+        return url_string + "?" + urllib.parse.urlencode(parms, quote_via=urllib.parse.quote_plus)
+    return url_string
 
 
 def exec_request(url_string, parms):
@@ -47,43 +627,86 @@ def exec_request(url_string, parms):
      Submit https request to IEX
     :param url_string:
     :param parms:
-    :param cacerts:
     :return: A dict containing results of https GET.
     the results key contains what was returned by the GET request.
     The status_code key is added to return the HTTPS status code.
     """
-
-    status_code = 666
-
+    url_enc = _encode_url(url_string, parms)
+    logger.debug("HTTPS GET: %s", url_enc)
+    start = time.time()
+    conn, response = _send_request(url_enc)
+    status_code = response.status
     try:
-        if parms:
-            url_enc = url_string + "?" + urllib.parse.urlencode(parms, quote_via=urllib.parse.quote_plus)
-        else:
-            url_enc = url_string
-        logger.debug("HTTPS GET: %s", url_enc)
-        response = urllib.request.urlopen(url_enc)
-        status_code = response.getcode()
-        logger.debug("Status code: %d", status_code)
-        res = response.read()
-        res = str(res, "utf-8")
-    except urllib.error.HTTPError as ex:
-        logger.error(ex.msg)
-        logger.error(str(ex))
-        return {"status_code":ex.code, "error_message":ex.msg}
+        res = _read_body(response)
+    finally:
+        _finish_response(conn, response, response.isclosed())
+        metrics.observe("http.latency", time.time() - start)
+    logger.debug("Status code: %d", status_code)
+    if status_code >= 400:
+        logger.error(response.reason)
+        logger.error("HTTP Error %d: %s", status_code, response.reason)
+        return {"status_code":status_code, "error_message":response.reason}
 
     # Not every URL returns something
     if res:
         # Guard against invalid result returned by URL
         try:
-            # In Python3 JSON produces string output which is Unicode
-            j = {"result": json.loads(res)}
-            logger.debug("JSON: %s", j)
+            # Decode straight from the bytes where the codec allows it.
+            # IEX responses are UTF-8.
+            j = {"result": json_loads(res if json_loads_bytes else str(res, "utf-8"))}
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("JSON: %s", _summarize_payload(res, j["result"]))
         except:
             logger.error("HTTPS GET: %s", url_string)
             logger.error("Status code: %d", status_code)
-            logger.error("Returned invalid/unexpected JSON response: %s", res)
-            j = {"bad_payload": res}
+            logger.error("Returned invalid/unexpected JSON response: %s", _summarize_payload(res))
+            j = {"bad_payload": str(res, "utf-8", "replace")}
         j["status_code"] = status_code
     else:
         j = {"status_code" : status_code}
     return j
+
+
+def exec_request_stream(url_string, parms, handle_item):
+    """
+    Submit https request to IEX for a JSON array and hand each element of the
+    array to handle_item as it arrives. The array is never held in memory.
+    :param url_string:
+    :param parms:
+    :param handle_item: Function called with each element. Returning False
+    stops reading the response (the connection is then closed).
+    :return: A dict with the status_code key and the number of elements
+    handled (count key). Errors are returned as by exec_request.
+    """
+    url_enc = _encode_url(url_string, parms)
+    logger.debug("HTTPS GET (streamed): %s", url_enc)
+    start = time.time()
+    conn, response = _send_request(url_enc)
+    status_code = response.status
+    count = 0
+    complete = False
+    try:
+        if status_code >= 400:
+            response.read()
+            complete = True
+        else:
+            complete = True
+            for item in iter_json_array(_iter_body(response)):
+                count += 1
+                if handle_item(item) is False:
+                    logger.debug("Stopped reading %s after %d items", url_enc, count)
+                    complete = False
+                    break
+    except ValueError as ex:
+        logger.error("HTTPS GET: %s", url_string)
+        logger.error("Returned invalid/unexpected JSON response: %s", str(ex))
+        complete = False
+        return {"status_code": status_code, "bad_payload": str(ex), "count": count}
+    finally:
+        _finish_response(conn, response, complete and response.isclosed())
+        metrics.observe("http.latency", time.time() - start)
+    logger.debug("Status code: %d, %d items", status_code, count)
+    if status_code >= 400:
+        logger.error("HTTP Error %d: %s", status_code, response.reason)
+        return {"status_code": status_code, "error_message": response.reason}
+    return {"status_code": status_code, "count": count}
@@ -0,0 +1,83 @@
+#
+# test_extn_helper - Tests for the LO Calc extension helpers
+# Copyright (C) 2018  Dave Hocker (email: Qalydon17@gmail.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, version 3 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the LICENSE.md file for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program (the LICENSE.md file).  If not, see <http://www.gnu.org/licenses/>.
+#
+# Run from the repository folder with: python -m unittest discover tests
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import extn_helper
+from extn_helper import normalize_date, normalize_dates
+
+# Marks a value normalize_date() rejects
+INVALID = "invalid"
+
+# Cell values of every kind a range can hold
+MIXED_VALUES = [
+    43524.0, 43524.75, 1.0, 0.5, -0.5, 60.0, 61.0, 25569.0, 2958465.0, 2958466.0,
+    -693593.0, -693594.0, -1e300, 1e300, float("nan"), float("inf"), float("-inf"),
+    0.0, -0.0, "", None, "2019-02-28", "2/28/19", "2019-2-5", "2019-02-30",
+    "2026-10-1 ", "2026- 1-05", "+202-10-15", "junk", 45000, True,
+]
+
+
+def expected(v):
+    try:
+        return normalize_date(v)
+    except ValueError:
+        return INVALID
+
+
+class TestNormalizeDates(unittest.TestCase):
+    def check(self, cell_range):
+        result = normalize_dates(cell_range, invalid=INVALID)
+        self.assertEqual([len(row) for row in result], [len(row) for row in cell_range])
+        for row, result_row in zip(cell_range, result):
+            for v, r in zip(row, result_row):
+                self.assertEqual(r, expected(v), "value {0!r}".format(v))
+
+    def test_scalar_path(self):
+        self.check(tuple((v,) for v in MIXED_VALUES))
+
+    def test_vectorized_path(self):
+        if extn_helper._numpy() is None:
+            self.skipTest("numpy is not available")
+        serials = [float(d) + f for d in range(40000, 40000 + extn_helper.vectorize_min_length)
+                   for f in (0.0, 0.99)]
+        values = serials + MIXED_VALUES
+        # Several columns, so row and column positions both matter
+        self.check(tuple(tuple(values[i:i + 3]) for i in range(0, len(values), 3)))
+
+    def test_single_value(self):
+        self.assertEqual(normalize_dates(43524.0), [["2019-02-28"]])
+
+    def test_serial_dates(self):
+        self.assertEqual(normalize_date(1.0), "1899-12-31")
+        self.assertEqual(normalize_date(43524.9), "2019-02-28")
+        self.assertEqual(normalize_date(2958465.0), "9999-12-31")
+
+    def test_iso_fast_path(self):
+        self.assertEqual(normalize_date("2019-02-28"), "2019-02-28")
+        for v in ["2026-10-1 ", "2026- 1-05", "+202-10-15"]:
+            self.assertRaises(ValueError, normalize_date, v)
+
+
+if __name__ == "__main__":
+    unittest.main()